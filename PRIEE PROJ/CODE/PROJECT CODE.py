@@ -40,25 +40,128 @@ setup(
     zip_safe=False,
 
 from _future_ import print_function
+from collections import deque
 from enum import Enum
-import re
+import hashlib
+import json
+import os
 import sys
 import platform
 import subprocess
+import threading
+import time
 import traceback
 import inspect
 from subprocess import PIPE, CalledProcessError
 
+from aimmo_runner.shell_api import (
+    TOOLCHAIN,
+    cached_download,
+    get_latest_github_version,
+    get_latest_kubectl_version,
+    run_graph,
+)
+
 # python2 support
 try:
     input = raw_input
 except NameError:
     pass
 
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
 
 MINIKUBE_VERSION = "latest"
 KUBECTL_VERSION = "latest"
 
+# Maximum number of setup tasks allowed to run at the same time
+SETUP_WORKERS = int(os.environ.get("AIMMO_SETUP_WORKERS", 4))
+
+# Serialises terminal output from tasks running in parallel
+_OUTPUT_LOCK = threading.Lock()
+
+# Lines of command output kept for failure reports, and the minimum number
+# of seconds between redraws of a command's progress line
+OUTPUT_BUFFER_LINES = 200
+REDRAW_INTERVAL = 0.1
+
+# Records the fingerprint of every finished task so re-runs can skip them
+SETUP_STATE_FILE = os.environ.get("AIMMO_SETUP_STATE", ".aimmo_setup_state.json")
+
+# What each skippable task's fingerprint is made of. "files" are hashed,
+# "tool" is the tool whose path and version identify what the task produced,
+# "probe" is a command whose output does the same, "inputs" are extra values
+# the task depends on (functions are called for them, so "latest" versions are
+# resolved each time). Tasks not listed here always run.
+TASK_FINGERPRINTS = {
+    "install_sqlite3": {"tool": "sqlite3"},
+    "install_nodejs": {"tool": "node"},
+    "install_yarn": {"tool": "yarn"},
+    "install_pipenv": {"tool": "pipenv"},
+    "build_pipenv_virtualenv": {"files": ["Pipfile", "Pipfile.lock"], "probe": "pipenv --venv"},
+    "set_up_frontend_dependencies": {
+        "files": [
+            "game_frontend/package.json",
+            "game_frontend/yarn.lock",
+            "game_frontend/node_modules/.yarn-integrity",
+        ],
+        "tool": "yarn",
+    },
+    "install_docker": {"tool": "docker"},
+    "install_minikube": {"tool": "minikube", "inputs": [lambda: _resolve_minikube_version(MINIKUBE_VERSION)]},
+    "install_kubectl": {"tool": "kubectl", "inputs": [lambda: _resolve_kubectl_version(KUBECTL_VERSION)]},
+    "install_helm": {"tool": "helm"},
+    "helm_add_agones_repo": {"probe": "helm repo list"},
+}
+
+# Where the timing report and its Chrome trace (chrome://tracing, Perfetto) are written
+SETUP_REPORT_FILE = os.environ.get("AIMMO_SETUP_REPORT", "aimmo_setup_report.json")
+SETUP_TRACE_FILE = os.environ.get("AIMMO_SETUP_TRACE", "aimmo_setup_trace.json")
+# Number of tasks flagged as slowest in the report
+SLOWEST_TASK_COUNT = 5
+
+# Packages needed to add the apt repositories below
+APT_PREREQUISITES = ["ca-certificates", "curl", "gnupg", "lsb-release"]
+
+# apt repositories the Linux setup may add. "source" is expanded by the shell.
+APT_REPOSITORIES = {
+    "nodesource": {
+        "key": "https://deb.nodesource.com/gpgkey/nodesource.gpg.key",
+        "keyring": "/usr/share/keyrings/nodesource.gpg",
+        "source": "deb [signed-by=/usr/share/keyrings/nodesource.gpg] https://deb.nodesource.com/node_14.x "
+        "$(lsb_release -cs) main",
+    },
+    "yarn": {
+        "key": "https://dl.yarnpkg.com/debian/pubkey.gpg",
+        "keyring": "/usr/share/keyrings/yarn-archive-keyring.gpg",
+        "source": "deb [signed-by=/usr/share/keyrings/yarn-archive-keyring.gpg] https://dl.yarnpkg.com/debian/ "
+        "stable main",
+    },
+    "docker": {
+        "key": "https://download.docker.com/linux/ubuntu/gpg",
+        "keyring": "/usr/share/keyrings/docker-archive-keyring.gpg",
+        "source": "deb [arch=$(dpkg --print-architecture) signed-by=/usr/share/keyrings/docker-archive-keyring.gpg] "
+        "https://download.docker.com/linux/ubuntu $(lsb_release -cs) stable",
+    },
+}
+
+# What the Linux setup needs from apt. Each entry is skipped when its tool is
+# available or its probe succeeds.
+APT_REQUIREMENTS = [
+    {"name": "nodejs", "tool": "node", "repositories": ["nodesource"], "packages": ["nodejs"]},
+    {"name": "yarn repository", "probe": "test -f /etc/apt/sources.list.d/yarn.list", "repositories": ["yarn"]},
+    {"name": "pip", "tool": "pip", "packages": ["python3-pip"]},
+    {
+        "name": "docker",
+        "tool": "docker",
+        "repositories": ["docker"],
+        "packages": ["docker-ce", "docker-ce-cli", "containerd.io"],
+    },
+]
+
 
 class OSType(Enum):
     MAC = 1
@@ -160,71 +263,422 @@ def setup_factory(os_type, arch_type):
     raise RuntimeError("could not find setup function for supplied host type")
 
 
-def mac_setup(os_type, arch_type):
+def mac_setup(os_type, arch_type, max_workers=SETUP_WORKERS):
     """
     Runs the commands needed in order to set up Kurono for MAC
     Args:
         os_type (OSType): host OS type
         arch_type (ArchType): host architecture type
+        max_workers (int): maximum number of tasks to run at the same time
     """
-    tasks = [
-        ensure_homebrew_installed,
-        install_sqlite3,
-        install_nodejs,
-        install_yarn,
-        set_up_frontend_dependencies,
-        install_pipenv,
-        build_pipenv_virtualenv,
-        install_docker,
-        install_minikube,
-        install_kubectl,
-        install_helm,
-        helm_add_agones_repo,
-        minikube_start_profile,
-        helm_install_aimmo,
-    ]
+    # Each task is mapped to the tasks that must finish before it can start.
+    # Homebrew holds a global lock, so the brew installs are chained.
+    task_graph = {
+        ensure_homebrew_installed: [],
+        install_sqlite3: [ensure_homebrew_installed],
+        install_nodejs: [install_sqlite3],
+        install_yarn: [install_nodejs],
+        set_up_frontend_dependencies: [install_yarn],
+        install_pipenv: [install_nodejs],
+        build_pipenv_virtualenv: [install_pipenv],
+        install_docker: [install_pipenv],
+        install_minikube: [],
+        install_kubectl: [],
+        install_helm: [],
+        helm_add_agones_repo: [install_helm],
+        minikube_start_profile: [install_docker, install_minikube, install_kubectl],
+        helm_install_aimmo: [minikube_start_profile, helm_add_agones_repo],
+    }
 
     _create_sudo_timestamp()
+    TOOLCHAIN.discover()
 
-    for task in tasks:
-        task(os_type, arch_type)
+    try:
+        run_task_graph(task_graph, os_type, arch_type, max_workers, SetupState(SETUP_STATE_FILE))
+    finally:
+        _report_timings(task_graph)
 
 
 def windows_setup(os_type, arch_type):
     raise NotImplementedError
 
 
-def linux_setup(os_type, arch_type):
+def linux_setup(os_type, arch_type, max_workers=SETUP_WORKERS):
     """
     Runs the commands needed in order to set up Kurono for LINUX
     Args:
         os_type (OSType): host OS type
         arch_type (ArchType): host architecture type
+        max_workers (int): maximum number of tasks to run at the same time
     """
-    tasks = [
-        update_apt_packages,
-        install_nodejs,
-        check_for_cmdtest,
-        configure_yarn_repo,
-        install_yarn,
-        install_pip,
-        install_pipenv,
-        build_pipenv_virtualenv,
-        set_up_frontend_dependencies,
-        install_docker,
-        install_minikube,
-        install_kubectl,
-        install_helm,
-        helm_add_agones_repo,
-        minikube_start_profile,
-        helm_install_aimmo,
-    ]
+    # Each task is mapped to the tasks that must finish before it can start.
+    # check_for_cmdtest may prompt the user so it runs on its own first, and
+    # everything that comes from apt (nodejs, pip, docker) is installed by
+    # install_apt_packages in a single apt transaction.
+    task_graph = {
+        check_for_cmdtest: [],
+        install_apt_packages: [check_for_cmdtest],
+        install_yarn: [install_apt_packages],
+        install_pipenv: [install_apt_packages],
+        build_pipenv_virtualenv: [install_pipenv],
+        set_up_frontend_dependencies: [install_yarn],
+        install_minikube: [check_for_cmdtest],
+        install_kubectl: [check_for_cmdtest],
+        install_helm: [check_for_cmdtest],
+        helm_add_agones_repo: [install_helm],
+        minikube_start_profile: [install_apt_packages, install_minikube, install_kubectl],
+        helm_install_aimmo: [minikube_start_profile, helm_add_agones_repo],
+    }
 
     _create_sudo_timestamp()
+    TOOLCHAIN.discover()
+
+    try:
+        run_task_graph(task_graph, os_type, arch_type, max_workers, SetupState(SETUP_STATE_FILE))
+    finally:
+        _report_timings(task_graph)
+
+
+def run_task_graph(task_graph, os_type, arch_type, max_workers=SETUP_WORKERS, state=None):
+    """
+    Run setup tasks concurrently, starting each task as soon as all of its
+    dependencies have finished. Once a task fails no new tasks are started, the
+    running ones are allowed to finish and the first error is re-raised.
+    Args:
+        task_graph (Dict[Callable, List[Callable]]): tasks mapped to the tasks they depend on
+        os_type (OSType): host OS type
+        arch_type (ArchType): host architecture type
+        max_workers (int): maximum number of tasks to run at the same time
+        state (SetupState): optional record of finished tasks used to skip unchanged ones
+    """
+
+    def run_task(task):
+        if state is None:
+            _TIMINGS.run_task(task, task, os_type, arch_type)
+        else:
+            _TIMINGS.run_task(task, state.run, task, os_type, arch_type, task_graph[task])
+
+    run_graph(task_graph, run_task, max_workers)
+
+
+class SetupState(object):
+    """
+    Fingerprints of finished setup tasks, persisted to a JSON file after every
+    task so that a re-run, or a resume after a failure, only runs the tasks
+    whose fingerprint has changed since they last finished.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fingerprints = {}
+        try:
+            with open(path) as state_file:
+                self._finished = json.load(state_file).get("tasks", {})
+        except (IOError, ValueError):
+            self._finished = {}
+
+    def run(self, task, os_type, arch_type, dependencies=()):
+        """
+        Run the task unless its fingerprint matches the one recorded when it last finished
+        Args:
+            task (Callable): setup task
+            os_type (OSType): host OS type
+            arch_type (ArchType): host architecture type
+            dependencies (List[Callable]): tasks this task depends on
+        Returns:
+            bool: False if the task was up to date and skipped
+        """
+        name = task.__name__
+        spec = TASK_FINGERPRINTS.get(name)
+        upstream = [self._fingerprints.get(dependency.__name__) for dependency in dependencies]
+
+        if spec is not None:
+            fingerprint = _task_fingerprint(name, spec, os_type, arch_type, upstream)
+            if self._is_current(name, fingerprint):
+                with _OUTPUT_LOCK:
+                    sys.stdout.write("\033[1m%s\033[0m... [ \033[94mUP TO DATE\033[0m ]\n" % name)
+                self._fingerprints[name] = fingerprint
+                return False
 
-    for task in tasks:
         task(os_type, arch_type)
 
+        if spec is not None:
+            # The tool and probe describe what the task produced, so take them again now it has run
+            if "tool" in spec:
+                TOOLCHAIN.forget(spec["tool"])
+            fingerprint = _task_fingerprint(name, spec, os_type, arch_type, upstream)
+            self._fingerprints[name] = fingerprint
+            self._record(name, fingerprint)
+
+        return True
+
+    def _is_current(self, name, fingerprint):
+        finished = self._finished.get(name)
+        return bool(finished) and finished.get("fingerprint") == fingerprint
+
+    def _record(self, name, fingerprint):
+        with self._lock:
+            self._finished[name] = {"fingerprint": fingerprint, "finished": time.time()}
+            temp_path = "%s.tmp" % self.path
+            with open(temp_path, "w") as state_file:
+                json.dump({"tasks": self._finished}, state_file, indent=2, sort_keys=True)
+            os.replace(temp_path, self.path)
+
+
+def _task_fingerprint(name, spec, os_type, arch_type, upstream):
+    """
+    Hash everything a task's outcome depends on
+    Args:
+        name (str): task name
+        spec (dict): entry from TASK_FINGERPRINTS
+        os_type (OSType): host OS type
+        arch_type (ArchType): host architecture type
+        upstream (List[str]): fingerprints of the tasks it depends on
+    Returns:
+        str: hex digest
+    """
+    digest = hashlib.sha256()
+    inputs = [value() if callable(value) else value for value in spec.get("inputs", [])]
+    for part in [name, os_type.name, arch_type.name] + inputs + upstream:
+        digest.update(("%s\0" % part).encode("utf-8"))
+
+    for path in spec.get("files", []):
+        digest.update(("%s\0" % path).encode("utf-8"))
+        digest.update(_file_digest(path).encode("utf-8"))
+
+    if "tool" in spec:
+        digest.update(("%s\0%s\0" % (TOOLCHAIN.path(spec["tool"]), TOOLCHAIN.version(spec["tool"]))).encode("utf-8"))
+
+    if "probe" in spec:
+        digest.update(_probe_output(spec["probe"]))
+
+    return digest.hexdigest()
+
+
+def _file_digest(path):
+    """
+    Return the SHA-256 of a file, or an empty string if it doesn't exist
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 16), b""):
+                digest.update(chunk)
+    except (IOError, OSError):
+        return ""
+    return digest.hexdigest()
+
+
+def _probe_output(command):
+    """
+    Run a quiet probe command, returning its output or a marker if it failed
+    """
+    try:
+        return subprocess.check_output(command, stderr=PIPE, shell=True)
+    except (CalledProcessError, OSError):
+        return b"\0failed"
+
+
+class SetupTimings(object):
+    """
+    Start and end times of every setup task and of every command run through _cmd
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._threads = {}
+        self.tasks = {}
+        self.commands = []
+
+    def run_task(self, task, runner, *args):
+        """
+        Time runner(*args) as the given task
+        Args:
+            task (Callable): setup task being run
+            runner (Callable): what actually runs it, the task itself or SetupState.run
+        """
+        self._local.task = task.__name__
+        start = time.time()
+        status = "failed"
+        try:
+            status = "up to date" if runner(*args) is False else "ok"
+        finally:
+            self._local.task = None
+            with self._lock:
+                self.tasks[task.__name__] = {
+                    "start": start,
+                    "end": time.time(),
+                    "status": status,
+                    "thread": self._thread_index(),
+                }
+
+    def record_command(self, name, command, start, returncode):
+        """
+        Record a finished command against the task running on this thread
+        Args:
+            name (str): command comment
+            command (str): command that was run
+            start (float): time the command started
+            returncode (int): command exit code
+        """
+        with self._lock:
+            self.commands.append(
+                {
+                    "name": name,
+                    "command": command,
+                    "task": getattr(self._local, "task", None),
+                    "start": start,
+                    "end": time.time(),
+                    "returncode": returncode,
+                    "thread": self._thread_index(),
+                }
+            )
+
+    def _thread_index(self):
+        return self._threads.setdefault(threading.current_thread().ident, len(self._threads) + 1)
+
+    def report(self, task_graph):
+        """
+        Build the timing report, marking the slowest tasks and the critical path
+        Args:
+            task_graph (Dict[Callable, List[Callable]]): tasks mapped to the tasks they depend on
+        Returns:
+            dict: report ready to be dumped as JSON
+        """
+        durations = dict((name, timing["end"] - timing["start"]) for name, timing in self.tasks.items())
+        critical_path, critical_seconds = _critical_path(task_graph, durations)
+        slowest = sorted(durations, key=durations.get, reverse=True)[:SLOWEST_TASK_COUNT]
+        origin = min([timing["start"] for timing in self.tasks.values()] or [0])
+
+        tasks = []
+        for task, dependencies in task_graph.items():
+            timing = self.tasks.get(task.__name__)
+            tasks.append(
+                {
+                    "name": task.__name__,
+                    "dependencies": [dependency.__name__ for dependency in dependencies],
+                    "status": timing["status"] if timing else "not run",
+                    "start": round(timing["start"] - origin, 3) if timing else None,
+                    "seconds": round(durations[task.__name__], 3) if timing else None,
+                    "slowest": task.__name__ in slowest,
+                    "critical": task.__name__ in critical_path,
+                }
+            )
+
+        commands = [
+            {
+                "name": command["name"],
+                "command": command["command"],
+                "task": command["task"],
+                "returncode": command["returncode"],
+                "start": round(command["start"] - origin, 3),
+                "seconds": round(command["end"] - command["start"], 3),
+            }
+            for command in self.commands
+        ]
+
+        return {
+            "total_seconds": round(max([timing["end"] for timing in self.tasks.values()] or [origin]) - origin, 3),
+            "critical_path": critical_path,
+            "critical_path_seconds": round(critical_seconds, 3),
+            "slowest": slowest,
+            "tasks": tasks,
+            "commands": commands,
+        }
+
+    def trace(self):
+        """
+        Build a Chrome trace event file of the recorded tasks and commands
+        Returns:
+            dict: trace ready to be dumped as JSON
+        """
+        events = []
+        for name, timing in self.tasks.items():
+            events.append(_trace_event(name, "task", timing, {"status": timing["status"]}))
+        for command in self.commands:
+            events.append(
+                _trace_event(
+                    command["name"],
+                    "command",
+                    command,
+                    {"command": command["command"], "task": command["task"], "returncode": command["returncode"]},
+                )
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def _trace_event(name, category, timing, args):
+    return {
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": int(timing["start"] * 1e6),
+        "dur": int((timing["end"] - timing["start"]) * 1e6),
+        "pid": 1,
+        "tid": timing["thread"],
+        "args": args,
+    }
+
+
+def _critical_path(task_graph, durations):
+    """
+    Find the chain of dependent tasks that took the longest in total
+    Args:
+        task_graph (Dict[Callable, List[Callable]]): tasks mapped to the tasks they depend on
+        durations (Dict[str, float]): seconds each task that ran took
+    Returns:
+        Tuple[List[str], float]: task names along the path, total seconds
+    """
+    finish = {}
+    previous = {}
+    pending = dict((task, set(dependencies)) for task, dependencies in task_graph.items())
+
+    while pending:
+        ready = [task for task, dependencies in pending.items() if not dependencies]
+        for task in ready:
+            del pending[task]
+            slowest_dependency = max(task_graph[task], key=lambda dependency: finish[dependency], default=None)
+            previous[task] = slowest_dependency
+            start = finish[slowest_dependency] if slowest_dependency else 0
+            finish[task] = start + durations.get(task.__name__, 0)
+        for dependencies in pending.values():
+            dependencies.difference_update(ready)
+
+    if not finish:
+        return [], 0
+
+    task = max(finish, key=finish.get)
+    total = finish[task]
+    path = []
+    while task is not None:
+        path.insert(0, task.__name__)
+        task = previous[task]
+    return path, total
+
+
+def _report_timings(task_graph):
+    """
+    Write the timing report and trace, then print the slowest tasks and the critical path
+    Args:
+        task_graph (Dict[Callable, List[Callable]]): tasks mapped to the tasks they depend on
+    """
+    report = _TIMINGS.report(task_graph)
+    with open(SETUP_REPORT_FILE, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+    with open(SETUP_TRACE_FILE, "w") as trace_file:
+        json.dump(_TIMINGS.trace(), trace_file)
+
+    durations = dict((task["name"], task["seconds"]) for task in report["tasks"])
+    print("\nSetup took %.1fs" % report["total_seconds"])
+    print("Slowest tasks: %s" % ", ".join("%s (%.1fs)" % (name, durations[name]) for name in report["slowest"]))
+    print("Critical path (%.1fs): %s" % (report["critical_path_seconds"], " -> ".join(report["critical_path"])))
+    print("Timing report written to %s, trace to %s" % (SETUP_REPORT_FILE, SETUP_TRACE_FILE))
+
+
+_TIMINGS = SetupTimings()
+
 
 def _create_sudo_timestamp():
     """
@@ -244,44 +698,92 @@ def _cmd(command, comment=None):
         command (str): command to be run
         comment (str): optional comment
     Returns:
-        Tuple[int, List[str]]: return code, stdout lines output
+        Tuple[int, List[str]]: return code, the first OUTPUT_BUFFER_LINES stdout lines output
     """
     stdout_lines = []
+    # Most recent stdout and stderr lines, interleaved, for the failure report
+    recent_lines = deque(maxlen=OUTPUT_BUFFER_LINES)
 
     if not comment:
         # Set comment to calling function name
         comment = inspect.currentframe().f_back.f_code.co_name
 
     if comment:
-        print(" " * 110, end="\r")
-        print("\033[1m%s\033[0m...\n" % comment, end="\r")
+        with _OUTPUT_LOCK:
+            print(" " * 110, end="\r")
+            print("\033[1m%s\033[0m...\n" % comment, end="\r")
 
+    start = time.time()
     p = subprocess.Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=True)
-
-    for line in iter(p.stdout.readline, b""):
-        stdout_lines.append(line.decode("utf-8"))
-        sys.stdout.write("%s\r" % line.decode("utf-8")[:-1].rstrip())
-        sys.stdout.flush()
+    # Nothing is ever written to the command, close stdin so it can't wait on it
+    p.stdin.close()
+
+    # Read both pipes on their own threads so neither can fill up and stall the command
+    lines = Queue()
+    readers = [
+        threading.Thread(target=_read_pipe, args=(p.stdout, "stdout", lines)),
+        threading.Thread(target=_read_pipe, args=(p.stderr, "stderr", lines)),
+    ]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+
+    open_pipes = len(readers)
+    last_redraw = 0
+    while open_pipes:
+        source, line = lines.get()
+        if line is None:
+            open_pipes -= 1
+            continue
+
+        recent_lines.append(line)
+        if source == "stdout" and len(stdout_lines) < OUTPUT_BUFFER_LINES:
+            stdout_lines.append(line)
+
+        now = time.time()
+        if now - last_redraw >= REDRAW_INTERVAL:
+            last_redraw = now
+            with _OUTPUT_LOCK:
+                sys.stdout.write("\x1b[2K%s\r" % line.rstrip()[:110])
+                sys.stdout.flush()
 
     # Delete line
-    sys.stdout.write("\x1b[2K")
-    sys.stdout.write("\x1b[1A")
+    with _OUTPUT_LOCK:
+        sys.stdout.write("\x1b[2K")
+        sys.stdout.write("\x1b[1A")
 
-    p.communicate()
+    p.wait()
+    _TIMINGS.record_command(comment, command, start, p.returncode)
 
     if p.returncode != 0:
-        if comment:
-            sys.stdout.write("\033[1m%s\033[0m... [ \033[93mFAILED\033[0m ]\n" % comment)
-        for line in stdout_lines:
-            sys.stdout.write(f"{line}\n")
+        with _OUTPUT_LOCK:
+            if comment:
+                sys.stdout.write("\033[1m%s\033[0m... [ \033[93mFAILED\033[0m ]\n" % comment)
+            for line in recent_lines:
+                sys.stdout.write(f"{line.rstrip()}\n")
         raise CalledProcessError(p.returncode, command)
 
     if comment:
-        sys.stdout.write("\033[1m%s\033[0m... [ \033[92mOK\033[0m ]\n" % comment)
+        with _OUTPUT_LOCK:
+            sys.stdout.write("\033[1m%s\033[0m... [ \033[92mOK\033[0m ]\n" % comment)
 
     return (p.returncode, stdout_lines)
 
 
+def _read_pipe(pipe, source, lines):
+    """
+    Decode each line from a command's pipe and queue it, followed by None once the pipe closes
+    Args:
+        pipe (file): stdout or stderr of the command
+        source (str): name of the pipe
+        lines (Queue): queue of (source, line) tuples
+    """
+    for line in iter(pipe.readline, b""):
+        lines.put((source, line.decode("utf-8", "replace")))
+    pipe.close()
+    lines.put((source, None))
+
+
 def ensure_homebrew_installed(os_type, arch_type):
     if os_type == OSType.MAC:
         _cmd("brew -v")
@@ -289,27 +791,23 @@ def ensure_homebrew_installed(os_type, arch_type):
 
 def install_sqlite3(os_type, arch_type):
     if os_type == OSType.MAC:
-        try:
-            if _cmd("sqlite3 -version", "check_sqlite3")[0] == 0:
-                return
-        except CalledProcessError:
-            pass
+        if TOOLCHAIN.available("sqlite3"):
+            return
 
         _cmd("brew install sqlite3")
+        TOOLCHAIN.forget("sqlite3")
 
 
 def install_yarn(os_type, arch_type):
     if os_type in [OSType.MAC, OSType.LINUX]:
-        try:
-            if _cmd("yarn --version ", "check_yarn")[0] == 0:
-                return
-        except CalledProcessError:
-            pass
+        if TOOLCHAIN.available("yarn"):
+            return
 
     if os_type == OSType.MAC:
         _cmd("npm install --global yarn", "install yarn")
     elif os_type == OSType.LINUX:
         _cmd("sudo npm install --global yarn", "install yarn")
+    TOOLCHAIN.forget("yarn")
 
 
 def set_up_frontend_dependencies(os_type, arch_type):
@@ -321,16 +819,14 @@ def set_up_frontend_dependencies(os_type, arch_type):
 
 def install_pipenv(os_type, arch_type):
     if os_type in [OSType.MAC, OSType.LINUX]:
-        try:
-            if _cmd("pipenv --version", "check_pipenv")[0] == 0:
-                return
-        except CalledProcessError:
-            pass
+        if TOOLCHAIN.available("pipenv"):
+            return
 
     if os_type == OSType.MAC:
         _cmd("brew install pipenv")
     elif os_type == OSType.LINUX:
         _cmd("pip install pipenv")
+    TOOLCHAIN.forget("pipenv")
 
 
 def build_pipenv_virtualenv(os_type, arch_type):
@@ -339,125 +835,97 @@ def build_pipenv_virtualenv(os_type, arch_type):
 
 
 def install_docker(os_type, arch_type):
-    if os_type in [OSType.MAC, OSType.LINUX]:
-        try:
-            if _cmd("docker -v", "check_docker")[0] == 0:
-                return
-        except CalledProcessError:
-            pass
-
+    # On Linux docker is installed by install_apt_packages
     if os_type == OSType.MAC:
+        if TOOLCHAIN.available("docker"):
+            return
+
         _cmd("brew install --cask docker")
-    elif os_type == OSType.LINUX:
-        # First time install needs to setup a repository
-        # Update the package and install them
-        # Add Docker's GPG key
-        # The following command is used to setup the stable repository
-        # Install docker
-        docker_install = """sudo apt-get update 
-                sudo apt-get install -y ca-certificates curl gnupg lsb-release
-                curl -fsSL https://download.docker.com/linux/ubuntu/gpg | sudo gpg --dearmor -o /usr/share/keyrings/docker-archive-keyring.gpg
-                echo \
-                "deb [arch=$(dpkg --print-architecture) signed-by=/usr/share/keyrings/docker-archive-keyring.gpg] https://download.docker.com/linux/ubuntu \
-                $(lsb_release -cs) stable" | sudo tee /etc/apt/sources.list.d/docker.list > /dev/null
-                sudo apt-get update
-                sudo apt-get install -y docker-ce
-                sudo apt-get install -y docker-ce-cli
-                sudo apt-get install -y containerd.io
-                """
-        try:
-            _cmd(docker_install)
-        except CalledProcessError:
-            print("\nInstalation failed, trying again..\n")
-            _cmd(docker_install)
+        TOOLCHAIN.forget("docker")
+
+
+def _resolve_minikube_version(version):
+    return get_latest_github_version("kubernetes/minikube") if version == "latest" else version
+
+
+def _resolve_kubectl_version(version):
+    return get_latest_kubectl_version() if version == "latest" else version
 
 
 def install_minikube(os_type, arch_type, version=MINIKUBE_VERSION):
     comment = "install_minikube"
-
-    if version == "latest":
-        rc, lines = _cmd("curl https://api.github.com/repos/kubernetes/minikube/releases/latest | grep tag_name")
-        match = re.search(r"(v[0-9\.]+)", lines[0])
-        if rc == 0 and match:
-            version = match.group(1)
+    version = _resolve_minikube_version(version)
 
     if os_type in [OSType.MAC, OSType.LINUX]:
-        try:
-            _, lines = _cmd("minikube version", "check_minikube")
-            if version in lines[0]:
-                return
-        except CalledProcessError:
-            pass
+        if TOOLCHAIN.version("minikube") == version.lstrip("v"):
+            return
 
     if os_type == OSType.MAC:
-        _cmd(
-            "curl -Lo minikube https://storage.googleapis.com/minikube/releases/%s/minikube-darwin-%s"
-            % (version, arch_type.name.lower()),
-            comment + ": download",
+        url = "https://storage.googleapis.com/minikube/releases/%s/minikube-darwin-%s" % (
+            version,
+            arch_type.name.lower(),
         )
     elif os_type == OSType.LINUX:
-        _cmd(
-            "curl -Lo minikube https://storage.googleapis.com/minikube/releases/%s/minikube-linux-%s"
-            % (version, arch_type.name.lower()),
-            comment + ": download",
+        url = "https://storage.googleapis.com/minikube/releases/%s/minikube-linux-%s" % (
+            version,
+            arch_type.name.lower(),
         )
 
     if os_type in [OSType.MAC, OSType.LINUX]:
-        _cmd("chmod +x minikube", comment + ": set permissions")
-        _cmd("sudo mv minikube /usr/local/bin/", comment + ": copy binary")
+        binary = cached_download(url, version, checksum_url=url + ".sha256")
+        _install_binary(binary, "minikube", comment)
+        TOOLCHAIN.forget("minikube")
 
 
 def install_kubectl(os_type, arch_type, version=KUBECTL_VERSION):
     comment = "install_kubectl"
-
-    if version == "latest":
-        rc, lines = _cmd("curl -L -s https://dl.k8s.io/release/stable.txt")
-        if rc == 0:
-            version = lines[0]
+    version = _resolve_kubectl_version(version)
 
     if os_type in [OSType.MAC, OSType.LINUX]:
-        try:
-            _, lines = _cmd("kubectl version --client --short", "check_kubectl")
-            if version in lines[0]:
-                return
-        except CalledProcessError:
-            pass
+        if TOOLCHAIN.version("kubectl") == version.lstrip("v"):
+            return
 
     if os_type == OSType.MAC:
-        _cmd(
-            "curl -Lo kubectl https://dl.k8s.io/release/%s/bin/darwin/%s/kubectl"
-            % (
-                version,
-                (arch_type.name).lower(),
-            ),
-            comment + ": download",
+        url = "https://dl.k8s.io/release/%s/bin/darwin/%s/kubectl" % (
+            version,
+            (arch_type.name).lower(),
         )
 
     if os_type == OSType.LINUX:
-        _cmd(
-            "curl -Lo kubectl https://dl.k8s.io/release/%s/bin/linux/%s/kubectl"
-            % (
-                version,
-                (arch_type.name).lower(),
-            ),
-            comment + ": download",
+        url = "https://dl.k8s.io/release/%s/bin/linux/%s/kubectl" % (
+            version,
+            (arch_type.name).lower(),
         )
 
     if os_type in [OSType.MAC, OSType.LINUX]:
-        _cmd("chmod +x kubectl", comment + ": set permissions")
-        _cmd("sudo mv kubectl /usr/local/bin/", comment + ": copy binary")
+        binary = cached_download(url, version, checksum_url=url + ".sha256")
+        _install_binary(binary, "kubectl", comment)
+        TOOLCHAIN.forget("kubectl")
+
+
+def _install_binary(source, name, comment, bin_dir="/usr/local/bin"):
+    """
+    Atomically install an executable: copy it next to its destination, then rename it into place
+    Args:
+        source (str): path of the binary in the download cache
+        name (str): name of the installed binary
+        comment (str): comment prefix for the commands run
+        bin_dir (str): directory to install into
+    """
+    dest = os.path.join(bin_dir, name)
+    _cmd(
+        'sudo cp "%s" "%s.tmp" && sudo chmod +x "%s.tmp" && sudo mv -f "%s.tmp" "%s"' % (source, dest, dest, dest, dest),
+        comment + ": install binary",
+    )
 
 
 def install_helm(os_type, arch_type):
     if os_type in [OSType.MAC, OSType.LINUX]:
-        try:
-            rc, _ = _cmd("helm version > /dev/null", "check_helm")
-            if rc == 0:
-                return
-        except CalledProcessError:
-            pass
+        if TOOLCHAIN.available("helm"):
+            return
 
         _cmd("curl https://raw.githubusercontent.com/helm/helm/master/scripts/get-helm-3 | bash")
+        TOOLCHAIN.forget("helm")
 
 
 def helm_add_agones_repo(os_type, arch_type):
@@ -487,27 +955,14 @@ def helm_install_aimmo(os_type, arch_type):
         )
 
 
-def install_pip(os_type, arch_type):
-    if os_type == OSType.LINUX:
-        try:
-            if _cmd("pip --version", "check_pip")[0] == 0:
-                return
-        except CalledProcessError:
-            pass
-        _cmd("sudo apt-get install python3-pip", "install_pip")
-
-
 def install_nodejs(os_type, arch_type):
-    if os_type in [OSType.MAC, OSType.LINUX]:
-        try:
-            if _cmd("node --version", "check_nodejs")[0] == 0:
-                return
-        except CalledProcessError:
-            pass
+    # On Linux nodejs is installed by install_apt_packages
     if os_type == OSType.MAC:
+        if TOOLCHAIN.available("node"):
+            return
+
         _cmd("brew install node@14")
-    if os_type == OSType.LINUX:
-        _cmd("curl -fsSL https://deb.nodesource.com/setup_14.x | sudo -E bash -" "sudo apt-get install -y nodejs")
+        TOOLCHAIN.forget("node")
 
 
 def check_for_cmdtest(os_type, arch_type):
@@ -538,22 +993,74 @@ def check_for_cmdtest(os_type, arch_type):
             print("Please answer 'yes' or 'no' ('y' or 'n').")
 
 
-def update_apt_packages(os_type, arch_type):
+def install_apt_packages(os_type, arch_type):
+    """
+    Install everything the Linux setup needs from apt in one go: add any missing
+    repositories, run apt-get update once, then install all packages in a single
+    apt-get install, instead of every task taking the dpkg lock on its own.
+    """
+    comment = "install_apt_packages"
+
     if os_type == OSType.LINUX:
-        _cmd("sudo apt-get update")
+        repositories, packages = plan_apt_packages()
+        if not repositories and not packages:
+            return
 
+        if repositories and not _probe_succeeds("command -v curl && command -v gpg && command -v lsb_release"):
+            _cmd(
+                "sudo apt-get update && sudo apt-get install -y %s" % " ".join(APT_PREREQUISITES),
+                comment + ": prerequisites",
+            )
 
-def configure_yarn_repo(os_type, arch_type):
-    comment = "configure_yarn"
-    if os_type == OSType.LINUX:
-        _cmd(
-            "curl -sS https://dl.yarnpkg.com/debian/pubkey.gpg | sudo apt-key add -",
-            comment + ": add key",
-        )
-        _cmd(
-            'echo "deb https://dl.yarnpkg.com/debian/ stable main" | sudo tee /etc/apt/sources.list.d/yarn.list',
-            comment + ": add repo",
-        )
+        for name in repositories:
+            repository = APT_REPOSITORIES[name]
+            _cmd(
+                "curl -fsSL %s | sudo gpg --dearmor --yes -o %s && "
+                'echo "%s" | sudo tee /etc/apt/sources.list.d/%s.list > /dev/null'
+                % (repository["key"], repository["keyring"], repository["source"], name),
+                comment + ": add %s repository" % name,
+            )
+
+        _cmd("sudo apt-get update", comment + ": update")
+
+        if packages:
+            _cmd("sudo apt-get install -y %s" % " ".join(packages), comment + ": install")
+
+        for requirement in APT_REQUIREMENTS:
+            if "tool" in requirement:
+                TOOLCHAIN.forget(requirement["tool"])
+
+
+def plan_apt_packages():
+    """
+    Work out which apt repositories and packages are still missing
+    Returns:
+        Tuple[List[str], List[str]]: repositories to add, packages to install
+    """
+    repositories = []
+    packages = []
+
+    for requirement in APT_REQUIREMENTS:
+        if "tool" in requirement and TOOLCHAIN.available(requirement["tool"]):
+            continue
+        if "probe" in requirement and _probe_succeeds(requirement["probe"]):
+            continue
+
+        for name in requirement.get("repositories", []):
+            if name not in repositories and not os.path.exists("/etc/apt/sources.list.d/%s.list" % name):
+                repositories.append(name)
+        for package in requirement.get("packages", []):
+            if package not in packages:
+                packages.append(package)
+
+    return repositories, packages
+
+
+def _probe_succeeds(command):
+    """
+    Run a quiet probe command and return whether it succeeded
+    """
+    return subprocess.call(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, shell=True) == 0
 
 
 if _name_ == "_main_":
@@ -584,12 +1091,18 @@ comment: false
 #!/usr/bin/env python
 import argparse
 import logging
+import sys
+import time
 import traceback
 
-from aimmo_runner import runner
-
 logging.basicConfig()
 
+# Importing the runner must take less than this many seconds and leave these
+# modules unimported, since they belong to the stages that use them. Checked
+# by --check-startup
+STARTUP_BUDGET = 0.1
+LAZY_MODULES = ["django", "kubernetes", "docker", "yaml", "psutil", "asyncio", "urllib.request"]
+
 parser = argparse.ArgumentParser(description="Runs Kurono.")
 
 parser.add_argument(
@@ -614,132 +1127,952 @@ parser.add_argument(
     disables the building of the Docker images and builds the frontend in production 
     mode without watching for changes.""",
 )
+parser.add_argument(
+    "-w",
+    "--watch",
+    dest="watch",
+    action="store_true",
+    default=False,
+    help="""Keep running and apply source changes as they are saved, rebuilding only
+    what each change affects: the worker wheel, the game images and fleet, or runserver.""",
+)
+parser.add_argument(
+    "--check-startup",
+    dest="check_startup",
+    action="store_true",
+    default=False,
+    help="""Check that importing the runner stays within its time budget without
+    importing any heavy dependencies, then exit.""",
+)
+
+
+def check_startup():
+    start = time.perf_counter()
+    from aimmo_runner import runner  # noqa: F401
+
+    elapsed = time.perf_counter() - start
+    loaded = [name for name in LAZY_MODULES if name in sys.modules]
+    print("Imported the runner in %.0fms, the budget is %.0fms" % (elapsed * 1000, STARTUP_BUDGET * 1000))
+    if loaded:
+        print("Imported too early: %s" % ", ".join(loaded))
+    return elapsed <= STARTUP_BUDGET and not loaded
+
 
 if _name_ == "_main_":
     try:
         args = parser.parse_args()
+        if args.check_startup:
+            sys.exit(0 if check_startup() else 1)
+
+        # Only imported now, so --help and bad arguments don't pay for it
+        from aimmo_runner import runner
 
         runner.run(
             using_cypress=args.using_cypress,
             build_target=args.build_target,
+            watch_mode=args.watch,
         )
     except Exception as err:
         traceback.print_exc()
         raise
 import atexit
+import hashlib
 import os
 import platform
+import posixpath
+import re
 import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import kubernetes
-from kubernetes.client import AppsV1Api, CoreV1Api
+import yaml
+from kubernetes.client import AppsV1Api, CoreV1Api, CustomObjectsApi
+from kubernetes.client.rest import ApiException
 from kubernetes.config import load_kube_config
+from kubernetes.dynamic import DynamicClient
 
 from .docker_scripts import build_docker_images
-from .shell_api import run_command
+from .shell_api import (
+    BASE_DIR,
+    CACHE_DIR,
+    TOOLCHAIN,
+    _read_json,
+    _update_json,
+    file_sha256,
+    log,
+    run_command,
+)
 
 MINIKUBE_EXECUTABLE = "minikube"
 
-
-def get_ip():
-    internal_ip = str(
-        run_command(
-            "minikube -p agones ssh grep host.minikube.internal /etc/hosts".split(),
-            capture_output=True,
-        ).split()[0],
-        "utf-8",
-    )
+FLEET_MANIFEST = os.path.join(BASE_DIR, "agones", "fleet.yml")
+RBAC_MANIFESTS = os.path.join(BASE_DIR, "rbac")
+# Field manager name used for server-side apply
+FIELD_MANAGER = "aimmo-runner"
+# Connections kept open to the API server by the shared client
+KUBE_CONNECTION_POOL_SIZE = 16
+# Seconds restart_pods waits for every replica of the fleet to be up
+FLEET_READY_TIMEOUT = int(os.environ.get("AIMMO_FLEET_READY_TIMEOUT", "300"))
+# Game server states that count as settled once a fleet update has rolled out
+SETTLED_GAME_SERVER_STATES = ("Ready", "Allocated", "Reserved")
+# Game server template annotation holding a hash of the images' build
+# contexts, so changed images roll out even though their tag stays the same
+IMAGES_ANNOTATION = "aimmo.ocadotech.com/images"
+
+# Kinds the cluster cache keeps current in the default namespace
+CACHED_KINDS = {
+    "deployments": {"api_version": "apps/v1", "kind": "Deployment"},
+    "services": {"api_version": "v1", "kind": "Service"},
+    "fleets": {"api_version": "agones.dev/v1", "kind": "Fleet"},
+    "gameservers": {"api_version": "agones.dev/v1", "kind": "GameServer"},
+}
+# Seconds to wait before listing again after a watch fails
+WATCH_RETRY_DELAY = 2
+
+# Host addresses resolved by get_ip, keyed by profile along with the boot ID
+# of the node they were resolved on
+HOST_IP_CACHE = os.path.join(CACHE_DIR, "minikube-host-ip.json")
+# How get_ip resolves the host address when it isn't cached: "ssh" reads it
+# from the node's /etc/hosts, "gateway" assumes it's the first address of
+# the node's subnet, which is where minikube puts it, without opening a session
+HOST_IP_LOOKUP = os.environ.get("AIMMO_HOST_IP_LOOKUP", "ssh")
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Images are built by docker_scripts.build_docker_images. Each image in the
+# node is also tagged with the revision of what it was built from: its build
+# context filtered by its .dockerignore, the build target and docker_scripts
+# itself. The build is skipped when the node already has every image tagged
+# with its current revision
+DOCKER_SCRIPTS = os.path.join(BASE_DIR, "aimmo_runner", "docker_scripts.py")
+# The name docker_scripts gives the image built from each context, filled in
+# with the context's directory name
+IMAGE_NAME = os.environ.get("AIMMO_IMAGE_NAME", "ocadotechnology/%s:test")
+REVISION_TAG_PREFIX = "rev-"
+# How images get into the minikube node: "docker-env" builds them with the
+# node's own docker daemon, "load" builds them with the host's daemon and
+# streams the images named in AIMMO_TRANSFER_IMAGES, or the ones that were
+# out of date, into the node's
+IMAGE_TRANSFER = os.environ.get("AIMMO_IMAGE_TRANSFER", "docker-env")
+TRANSFER_IMAGES = os.environ.get("AIMMO_TRANSFER_IMAGES", "").split()
+
+# Teardown deletes everything in the default namespace matching this label
+# selector (everything if empty), gives up after TEARDOWN_TIMEOUT seconds and
+# by default runs in a detached process so the runner can exit straight away
+TEARDOWN_LABEL_SELECTOR = os.environ.get("AIMMO_TEARDOWN_LABEL_SELECTOR") or None
+TEARDOWN_TIMEOUT = int(os.environ.get("AIMMO_TEARDOWN_TIMEOUT", 30))
+TEARDOWN_IN_BACKGROUND = os.environ.get("AIMMO_TEARDOWN_IN_BACKGROUND", "1") != "0"
+TEARDOWN_LOG = os.path.join(BASE_DIR, ".runner-logs", "teardown.log")
+# Process ID of the background teardown, which the next start waits on so
+# the teardown can't delete what it creates. Seconds the teardown process is
+# allowed on top of TEARDOWN_TIMEOUT to start up and connect
+TEARDOWN_PID = os.path.join(BASE_DIR, ".runner-logs", "teardown.pid")
+TEARDOWN_STARTUP = 30
+# The fleet is left running at exit so the next start can update it in place
+# instead of cold starting every game server; set this to delete it as well
+TEARDOWN_FLEET = os.environ.get("AIMMO_TEARDOWN_FLEET", "0") == "1"
+
+
+def get_ip(profile="agones", lookup=HOST_IP_LOOKUP):
+    """
+    The address of the host as seen from inside the minikube node. It's cached
+    until the node reboots or is recreated, which changes its boot ID, and
+    kept in memory for the rest of the process once known.
+    AIMMO_HOST_IP overrides it entirely.
+    :param lookup: how to resolve an uncached address, see HOST_IP_LOOKUP.
+    """
+    if os.environ.get("AIMMO_HOST_IP"):
+        return os.environ["AIMMO_HOST_IP"]
+    with _clients_lock:
+        if ("host_ip", profile) in _clients:
+            return _clients[("host_ip", profile)]
+
+    node = _read_node(profile)
+    boot_id = node.status.node_info.boot_id if node else None
+    cached = _read_json(HOST_IP_CACHE).get(profile)
+    if boot_id and cached and cached["boot_id"] == boot_id:
+        with _clients_lock:
+            _clients[("host_ip", profile)] = cached["ip"]
+        return cached["ip"]
+
+    if lookup == "gateway" and node:
+        internal_ip = _gateway_ip(node)
+    else:
+        internal_ip = str(
+            run_command(
+                [MINIKUBE_EXECUTABLE, "-p", profile, "ssh", "grep", "host.minikube.internal", "/etc/hosts"],
+                capture_output=True,
+            ).split()[0],
+            "utf-8",
+        )
+    if boot_id:
+        _update_json(HOST_IP_CACHE, profile, {"boot_id": boot_id, "ip": internal_ip})
+        with _clients_lock:
+            _clients[("host_ip", profile)] = internal_ip
     return internal_ip
 
 
-def delete_components():
-    apps_api_instance = AppsV1Api()
-    api = CoreV1Api()
-    for rs in apps_api_instance.list_namespaced_deployment("default").items:
-        apps_api_instance.delete_namespaced_deployment(
-            body=kubernetes.client.V1DeleteOptions(),
-            name=rs.metadata.name,
-            namespace="default",
-            grace_period_seconds=0,
-        )
-    for service in api.list_namespaced_service(namespace="default").items:
-        api.delete_namespaced_service(service.metadata.name, "default")
+def _read_node(profile):
+    """
+    The node of the profile's single node cluster, which minikube names after
+    the profile. It's read once per process; the kube config is only loaded if
+    the shared client doesn't exist yet.
+    :return: the node, or None if it can't be read.
+    """
+    with _clients_lock:
+        node = _clients.get(("node", profile))
+        configured = "api" in _clients
+    if node is not None:
+        return node
+    try:
+        if not configured:
+            load_kube_config(context=profile)
+        node = CoreV1Api(api_client()).read_node(profile)
+    except Exception as e:
+        log("Could not read the %s node: %s" % (profile, e))
+        return None
+    with _clients_lock:
+        return _clients.setdefault(("node", profile), node)
+
 
-    delete_fleet_on_exit()
+def _gateway_ip(node):
+    internal = [address.address for address in node.status.addresses if address.type == "InternalIP"]
+    return internal[0].rsplit(".", 1)[0] + ".1"
 
 
-def restart_pods():
+def api_client():
     """
-    Disables all the components running in the cluster and starts them again
-    with fresh updated state.
-    :param game_creator_yaml: Replication controller yaml settings file.
+    The connection-pooled client every cluster call in this module shares, so
+    they reuse the same TLS connections. Only call it once the kube config is loaded.
     """
-    print("Restarting pods")
+    with _clients_lock:
+        if "api" not in _clients:
+            configuration = kubernetes.client.Configuration.get_default_copy()
+            configuration.connection_pool_maxsize = KUBE_CONNECTION_POOL_SIZE
+            _clients["api"] = kubernetes.client.ApiClient(configuration)
+        return _clients["api"]
 
-    try:
-        run_command(["kubectl", "create", "-f", "agones/fleet.yml"])
-    except subprocess.CalledProcessError:
-        run_command("kubectl delete fleet aimmo-game --ignore-not-found".split(" "))
-        run_command("kubectl delete --all deployment -n default".split(" "))
-        run_command(["kubectl", "create", "-f", "agones/fleet.yml"])
 
+def dynamic_client():
+    # API discovery is slow, so the dynamic client is only created once too
+    client = api_client()
+    with _clients_lock:
+        if "dynamic" not in _clients:
+            _clients["dynamic"] = DynamicClient(client)
+        return _clients["dynamic"]
 
-def create_roles():
+
+def cluster_cache():
     """
-    Applies the service accounts, roles, and bindings for restricting
-    the rights of certain pods and their processses.
+    The ClusterCache shared by this module, started the first time it's needed.
     """
-    run_command(["kubectl", "apply", "-Rf", "rbac"])
-
-
-def delete_fleet_on_exit():
-    print("Exiting")
-    print("Deleting aimmo-game fleet")
-    run_command(
-        [
-            "kubectl",
-            "delete",
-            "fleet",
-            "aimmo-game",
-            "--ignore-not-found",
-        ]
-    )
+    with _clients_lock:
+        if "cache" not in _clients:
+            _clients["cache"] = ClusterCache()
+            _clients["cache"].start()
+        return _clients["cache"]
 
 
-def start(build_target=None):
+class ClusterCache(object):
     """
-    The entry point to the minikube class. Sends calls appropriately to set
-    up minikube.
+    Informer-style cache of the deployments, services, fleets and game servers
+    in a namespace. Each kind is listed once, then kept current by a watch
+    stream on its own background thread, so reads never hit the API server
+    and waiters are woken as soon as the state they wait for arrives.
     """
-    if platform.machine().lower() not in ("amd64", "x86_64"):
-        raise ValueError("Requires 64-bit")
-    os.environ["MINIKUBE_PATH"] = MINIKUBE_EXECUTABLE
 
-    # We assume the minikube was started with a profile called "agones"
-    load_kube_config(context="agones")
+    def __init__(self, namespace="default"):
+        self.namespace = namespace
+        self._condition = threading.Condition()
+        self._objects = dict((kind, {}) for kind in CACHED_KINDS)
+        self._synced = set()
+        self._stopped = threading.Event()
+
+    def start(self):
+        for kind in CACHED_KINDS:
+            thread = threading.Thread(target=self._inform, args=(kind,), name="watch-%s" % kind)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def synced(self, kind):
+        with self._condition:
+            return kind in self._synced
+
+    def get(self, kind, name):
+        with self._condition:
+            return self._objects[kind].get(name)
+
+    def list(self, kind):
+        with self._condition:
+            return list(self._objects[kind].values())
+
+    def wait_for(self, predicate, timeout):
+        """
+        Block until predicate(cache) is true, re-checking it whenever the cache changes.
+        :return: whether the predicate became true within timeout seconds.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: predicate(self), timeout)
+
+    def wait_for_fleet_ready(self, name, timeout, generation=0):
+        """
+        Block until the fleet has at least generation, every replica it asks
+        for is up and none of its game servers are still being replaced.
+        Allocated and reserved game servers count towards the fleet's replicas
+        but not its ready ones, so they count as up too.
+        :return: whether that happened within timeout seconds.
+        """
+
+        def ready(cache):
+            fleet = cache.get("fleets", name)
+            if fleet is None or fleet["metadata"].get("generation", 0) < generation:
+                return False
+            replicas = fleet.get("spec", {}).get("replicas", 0)
+            status = fleet.get("status", {})
+            up = sum(status.get(key, 0) for key in ("readyReplicas", "allocatedReplicas", "reservedReplicas"))
+            if up < replicas:
+                return False
+            return all(
+                server.get("status", {}).get("state") in SETTLED_GAME_SERVER_STATES
+                for server in cache.list("gameservers")
+                if server["metadata"].get("labels", {}).get("agones.dev/fleet") == name
+            )
+
+        return self.wait_for(ready, timeout)
+
+    def _inform(self, kind):
+        while not self._stopped.is_set():
+            try:
+                client = dynamic_client()
+                resource = client.resources.get(**CACHED_KINDS[kind])
+                listing = client.get(resource, namespace=self.namespace)
+                with self._condition:
+                    self._objects[kind] = dict(
+                        (item["metadata"]["name"], item) for item in listing.to_dict()["items"]
+                    )
+                    self._synced.add(kind)
+                    self._condition.notify_all()
+
+                # The watcher resumes from the last version it saw until it's told the version is too old
+                for event in client.watch(
+                    resource, namespace=self.namespace, resource_version=listing.metadata.resourceVersion
+                ):
+                    if self._stopped.is_set():
+                        return
+                    self._apply_event(kind, event)
+            except Exception as e:
+                if not (isinstance(e, ApiException) and e.status == 410):
+                    log("Watching %s failed, listing again: %s" % (kind, e))
+                    self._stopped.wait(WATCH_RETRY_DELAY)
+
+    def _apply_event(self, kind, event):
+        obj = event["raw_object"]
+        name = obj["metadata"]["name"]
+        with self._condition:
+            if event["type"] == "DELETED":
+                self._objects[kind].pop(name, None)
+            else:
+                self._objects[kind][name] = obj
+            self._condition.notify_all()
+
+
+def load_manifests(path):
+    """
+    Load every object from a YAML manifest, or from all manifests under a directory.
+    """
+    if os.path.isdir(path):
+        paths = sorted(
+            os.path.join(directory, filename)
+            for directory, _, filenames in os.walk(path)
+            for filename in filenames
+            if filename.endswith((".yml", ".yaml", ".json"))
+        )
+    else:
+        paths = [path]
+
+    manifests = []
+    for manifest_path in paths:
+        with open(manifest_path) as f:
+            manifests.extend(manifest for manifest in yaml.safe_load_all(f) if manifest)
+    return manifests
+
+
+def apply_manifests(path, namespace="default"):
+    # The in-process equivalent of `kubectl apply -Rf path`, using server-side apply
+    client = dynamic_client()
+    for manifest in load_manifests(path):
+        resource = client.resources.get(api_version=manifest["apiVersion"], kind=manifest["kind"])
+        client.server_side_apply(
+            resource,
+            body=manifest,
+            namespace=manifest.get("metadata", {}).get("namespace", namespace) if resource.namespaced else None,
+            field_manager=FIELD_MANAGER,
+            force_conflicts=True,
+        )
 
-    create_roles()
-    build_docker_images(MINIKUBE_EXECUTABLE, build_target=build_target)
-    restart_pods()
-    atexit.register(delete_components)
-    print("Cluster ready")
-[7:08 PM, 5/19/2024] Aaron Joel Cse Rec: from _future_ import absolute_import
 
-import logging
-import os
-import sys
+def delete_components(timeout=TEARDOWN_TIMEOUT, delete_fleet=TEARDOWN_FLEET):
+    """
+    Delete the deployments, services and, if delete_fleet is set, the fleet in
+    the default namespace, each with a single collection delete, all at the
+    same time and within timeout seconds.
+    """
+    apps_api_instance = AppsV1Api(api_client())
+    api = CoreV1Api(api_client())
+    deletes = {
+        "deployments": lambda: apps_api_instance.delete_collection_namespaced_deployment(
+            "default",
+            label_selector=TEARDOWN_LABEL_SELECTOR,
+            grace_period_seconds=0,
+            _request_timeout=timeout,
+        ),
+        # The API server's own service lives in default too
+        "services": lambda: api.delete_collection_namespaced_service(
+            "default",
+            label_selector=TEARDOWN_LABEL_SELECTOR,
+            field_selector="metadata.name!=kubernetes",
+            _request_timeout=timeout,
+        ),
+    }
+    if delete_fleet:
+        deletes["fleets"] = delete_fleet_on_exit
+
+    # Skip kinds a running cluster cache already knows to be empty
+    cache = _clients.get("cache")
+    if cache is not None:
+        for kind in list(deletes):
+            objects = [obj for obj in cache.list(kind) if obj["metadata"]["name"] != "kubernetes"]
+            if cache.synced(kind) and not objects:
+                del deletes[kind]
+    if not deletes:
+        return
+
+    executor = ThreadPoolExecutor(max_workers=len(deletes))
+    done, not_done = wait([executor.submit(delete) for delete in deletes.values()], timeout=timeout)
+    executor.shutdown(wait=False)
+
+    for future in done:
+        if future.exception() is not None:
+            log("Teardown step failed: %s" % future.exception())
+    if not_done:
+        log("Teardown did not finish within %ds" % timeout)
+
+
+def delete_components_on_exit():
+    if not TEARDOWN_IN_BACKGROUND:
+        delete_components()
+        return
+
+    print("Tearing down the cluster in the background, see %s" % TEARDOWN_LOG)
+    if not os.path.isdir(os.path.dirname(TEARDOWN_LOG)):
+        os.makedirs(os.path.dirname(TEARDOWN_LOG))
+    with open(TEARDOWN_LOG, "w") as teardown_log:
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "from aimmo_runner import minikube; "
+                "minikube.load_kube_config(context='agones'); "
+                "minikube.delete_components()",
+            ],
+            cwd=BASE_DIR,
+            stdin=subprocess.DEVNULL,
+            stdout=teardown_log,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+    with open(TEARDOWN_PID, "w") as f:
+        f.write("%d\n" % process.pid)
 
-import django
-from django.conf import settings
 
-from .shell_api import log, run_command, run_command_async
+def wait_for_teardown():
+    """
+    Wait for a background teardown left by an earlier run to finish. Without
+    a label selector it deletes every deployment and service, including the
+    ones this run is about to create.
+    """
+    try:
+        with open(TEARDOWN_PID) as f:
+            pid = int(f.read())
+        deadline = os.path.getmtime(TEARDOWN_PID) + TEARDOWN_TIMEOUT + TEARDOWN_STARTUP
+    except (OSError, ValueError):
+        return
+
+    # Past the deadline the process ID may well belong to something else
+    if time.time() < deadline and _pid_running(pid):
+        log("Waiting for the previous run's teardown to finish, see %s" % TEARDOWN_LOG)
+        while time.time() < deadline and _pid_running(pid):
+            time.sleep(0.2)
+        if _pid_running(pid):
+            raise RuntimeError("The previous run's teardown (pid %d) is still running" % pid)
+    try:
+        os.remove(TEARDOWN_PID)
+    except OSError:
+        pass
 
-ROOT_DIR_LOCATION = os.path.abspath(os.path.dirname((os.path.dirname(_file_))))
+
+def _pid_running(pid):
+    try:
+        import psutil
+    except ImportError:
+        # Signal 0 only checks the process exists on POSIX, on Windows it's CTRL_C_EVENT
+        if os.name == "nt":
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+    return psutil.pid_exists(pid)
+
+
+def restart_pods(timeout=FLEET_READY_TIMEOUT, revision=None):
+    """
+    Brings the fleet in the cluster up to date with agones/fleet.yml and waits
+    for it to be ready. The fleet is updated in place with server-side apply,
+    so Agones only replaces the game servers whose template changed and an
+    unchanged fleet is left running as it is.
+    :param revision: revision of all the images stamped on the template, see images_revision.
+    """
+    print("Restarting pods")
+
+    fleet = load_manifests(FLEET_MANIFEST)[0]
+    name = fleet["metadata"]["name"]
+    if revision is not None:
+        template_metadata = fleet["spec"]["template"].setdefault("metadata", {})
+        template_metadata.setdefault("annotations", {})[IMAGES_ANNOTATION] = revision
+    client = dynamic_client()
+    applied = client.server_side_apply(
+        client.resources.get(api_version=fleet["apiVersion"], kind=fleet["kind"]),
+        body=fleet,
+        namespace="default",
+        field_manager=FIELD_MANAGER,
+        force_conflicts=True,
+    )
+
+    if not cluster_cache().wait_for_fleet_ready(name, timeout, generation=applied.metadata.generation):
+        raise RuntimeError("Fleet %s was not ready within %ds" % (name, timeout))
+
+
+def image_contexts():
+    # Every top level directory with a Dockerfile is a build context
+    return sorted(
+        path
+        for path in (os.path.join(BASE_DIR, name) for name in os.listdir(BASE_DIR))
+        if os.path.isfile(os.path.join(path, "Dockerfile"))
+    )
+
+
+def image_revisions(build_target=None):
+    """
+    The name of the image built from each context mapped to a revision that
+    changes whenever anything that image is built from does.
+    """
+    scripts = file_sha256(DOCKER_SCRIPTS) if os.path.exists(DOCKER_SCRIPTS) else ""
+    revisions = {}
+    for context in image_contexts():
+        hasher = hashlib.sha256(("%s\0%s\0%s" % (build_target, scripts, hash_context(context))).encode("utf-8"))
+        revisions[IMAGE_NAME % os.path.basename(context)] = hasher.hexdigest()[:24]
+    return revisions
+
+
+def images_revision(revisions):
+    # One revision for the whole set of images, see image_revisions
+    hasher = hashlib.sha256()
+    for name in sorted(revisions):
+        hasher.update(("%s\0%s\0" % (name, revisions[name])).encode("utf-8"))
+    return hasher.hexdigest()[:24]
+
+
+def hash_context(context):
+    """
+    SHA-256 over the path and content of every file docker would send as the
+    build context, following .dockerignore the way docker does: patterns are
+    relative to the context root, `**` spans directories, a pattern matching a
+    parent directory matches everything in it and the last matching pattern
+    decides, so `!` exceptions re-include files. The Dockerfile and
+    .dockerignore are always sent.
+    """
+    patterns = _dockerignore_patterns(context)
+    # Without exceptions nothing under an excluded directory is sent, so it needn't be walked
+    prune = not any(exception for _, _, exception in patterns)
+    hasher = hashlib.sha256()
+    for directory, subdirectories, filenames in os.walk(context):
+        relative = os.path.relpath(directory, context)
+        prefix = "" if relative == "." else relative.replace(os.sep, "/") + "/"
+        subdirectories.sort()
+        if prune:
+            subdirectories[:] = [name for name in subdirectories if not _dockerignored(prefix + name, patterns)]
+        for name in sorted(filenames):
+            path = prefix + name
+            if path in ("Dockerfile", ".dockerignore") or not _dockerignored(path, patterns):
+                hasher.update(path.encode("utf-8") + b"\0")
+                hasher.update(file_sha256(os.path.join(directory, name)).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def _dockerignore_patterns(context):
+    # (regex, number of path segments, is an exception) for each pattern, in order
+    try:
+        with open(os.path.join(context, ".dockerignore")) as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return []
+
+    patterns = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        exception = line.startswith("!")
+        if exception:
+            line = line[1:].strip()
+        # docker cleans each pattern and anchors it at the context root
+        line = posixpath.normpath(line).lstrip("/")
+        if line in ("", "."):
+            continue
+        patterns.append((_dockerignore_regex(line), len(line.split("/")), exception))
+    return patterns
+
+
+def _dockerignore_regex(pattern):
+    regex = ""
+    i = 0
+    in_class = False
+    while i < len(pattern):
+        char = pattern[i]
+        if in_class:
+            regex += char
+            in_class = char != "]"
+        elif char == "*":
+            if pattern[i + 1 : i + 2] == "*":
+                i += 1
+                # "**/" is the same as "**"
+                if pattern[i + 1 : i + 2] == "/":
+                    i += 1
+                regex += ".*" if i + 1 == len(pattern) else "(.*/)?"
+            else:
+                regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[":
+            regex += char
+            in_class = True
+        elif char == "\\" and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(char)
+        i += 1
+    return re.compile(regex)
+
+
+def _dockerignored(path, patterns):
+    parents = path.split("/")[:-1]
+    ignored = False
+    for regex, segments, exception in patterns:
+        matched = regex.fullmatch(path) is not None
+        # A pattern naming a directory covers everything in it
+        if not matched and segments <= len(parents):
+            matched = regex.fullmatch("/".join(parents[:segments])) is not None
+        if matched:
+            ignored = not exception
+    return ignored
+
+
+def update_game_servers(build_target=None, image_transfer=IMAGE_TRANSFER):
+    """
+    Rebuild the images if anything they're built from changed and roll the
+    fleet out onto them. Game servers are only replaced if the images changed.
+    """
+    revisions = image_revisions(build_target)
+    provide_images(image_transfer, build_target=build_target, revisions=revisions)
+    restart_pods(revision=images_revision(revisions))
+
+
+def provide_images(strategy=IMAGE_TRANSFER, build_target=None, revisions=None):
+    """
+    Make sure the minikube node has up to date images, using the given transfer
+    strategy. What's in date is decided by the node's own docker daemon, so
+    images another checkout built or that were removed from the node are
+    built again.
+    :param revisions: image names mapped to their revisions, see image_revisions.
+    :return: each step taken mapped to the seconds it took.
+    """
+    start = time.time()
+    if strategy not in ("docker-env", "load"):
+        raise ValueError("Unknown image transfer strategy '%s'" % strategy)
+
+    node = minikube_docker_client()
+    revisions = revisions or image_revisions(build_target)
+    stale = stale_images(node, revisions)
+    report = {"check": time.time() - start}
+    if not stale:
+        log("Images in the node are up to date, skipping the image build")
+        return report
+    log("Out of date in the node: %s" % ", ".join(sorted(stale)))
+
+    # docker_scripts builds every image, one after the other, in a single call
+    # and has no way to build only some of them, so one out of date image
+    # rebuilds them all. Docker's layer cache keeps the unchanged ones quick.
+    # Building only the stale images, concurrently, has to be done inside
+    # docker_scripts itself.
+    if strategy == "docker-env":
+        build_docker_images(MINIKUBE_EXECUTABLE, build_target=build_target)
+        report["build"] = time.time() - start
+    else:
+        import docker
+
+        build_docker_images(None, build_target=build_target)
+        report["build"] = time.time() - start
+        for name, (status, seconds) in transfer_images(docker.from_env(), node, TRANSFER_IMAGES or stale).items():
+            report["%s %s" % (name, status)] = seconds
+
+    tagged = time.time()
+    tag_revisions(node, dict((name, revisions[name]) for name in stale))
+    report["tag"] = time.time() - tagged
+    for step, seconds in report.items():
+        log("%s: %.1fs" % (step, seconds))
+    log("Images ready using the '%s' strategy in %.1fs" % (strategy, time.time() - start))
+    return report
+
+
+def stale_images(client, revisions):
+    """
+    The images that client's daemon doesn't have, or has but not tagged with
+    their revision by tag_revisions.
+    :param revisions: image names mapped to their revisions.
+    """
+    import docker
+
+    stale = []
+    for name, revision in sorted(revisions.items()):
+        try:
+            current = client.images.get(name).id == client.images.get(_revision_tag(name, revision)).id
+        except docker.errors.ImageNotFound:
+            current = False
+        if not current:
+            stale.append(name)
+    return stale
+
+
+def tag_revisions(client, revisions):
+    """
+    Tag each image in client's daemon with its revision, removing its older
+    revision tags so the images they point to can be pruned.
+    :param revisions: image names mapped to their revisions.
+    """
+    for name, revision in revisions.items():
+        current = _revision_tag(name, revision)
+        repository, tag = current.rsplit(":", 1)
+        client.images.get(name).tag(repository, tag=tag)
+        for image in client.images.list(name=repository):
+            for old in image.tags:
+                if old.startswith("%s:%s" % (repository, REVISION_TAG_PREFIX)) and old != current:
+                    client.images.remove(old)
+
+
+def _revision_tag(name, revision):
+    # The name with its tag, if it has one, swapped for the revision
+    repository = name.rsplit(":", 1)[0] if ":" in name.rsplit("/", 1)[-1] else name
+    return "%s:%s%s" % (repository, REVISION_TAG_PREFIX, revision)
+
+
+def transfer_images(source, dest, names=None):
+    """
+    Stream each image from one docker daemon into another, straight from the
+    save API into the load API with no copy on disk. Images the destination
+    already has with the same ID aren't sent at all, and the daemon skips
+    registering any layers it already has.
+    :param names: images to transfer, TRANSFER_IMAGES by default.
+    :return: image names mapped to ("transferred" or "already on node", seconds taken).
+    """
+    import docker
+
+    report = {}
+    for name in names or TRANSFER_IMAGES:
+        start = time.time()
+        image = source.images.get(name)
+        try:
+            if dest.images.get(name).id == image.id:
+                report[name] = ("already on node", time.time() - start)
+                continue
+        except docker.errors.ImageNotFound:
+            pass
+
+        sent = [0]
+
+        def chunks():
+            for chunk in source.api.get_image(name):
+                sent[0] += len(chunk)
+                yield chunk
+
+        dest.api.load_image(chunks())
+        report[name] = ("transferred", time.time() - start)
+        log("%s transferred %.1fMB in %.1fs" % (name, sent[0] / 1e6, time.time() - start))
+    return report
+
+
+def minikube_docker_client():
+    """
+    Create a docker client for the docker daemon inside the agones minikube profile.
+    """
+    import docker
+
+    # The "none" shell prints plain KEY=VALUE lines, meant for parsing
+    output = run_command([MINIKUBE_EXECUTABLE, "-p", "agones", "docker-env", "--shell", "none"], capture_output=True)
+    env = dict(line.split("=", 1) for line in output.decode("utf-8").splitlines() if "=" in line)
+    return docker.from_env(environment=env)
+
+
+def create_roles():
+    """
+    Applies the service accounts, roles, and bindings for restricting
+    the rights of certain pods and their processses.
+    """
+    apply_manifests(RBAC_MANIFESTS)
+
+
+def delete_fleet_on_exit():
+    print("Exiting")
+    print("Deleting aimmo-game fleet")
+    try:
+        CustomObjectsApi(api_client()).delete_namespaced_custom_object(
+            "agones.dev", "v1", "default", "fleets", "aimmo-game", _request_timeout=TEARDOWN_TIMEOUT
+        )
+    except ApiException as e:
+        if e.status != 404:
+            raise
+
+
+def start(build_target=None, image_transfer=IMAGE_TRANSFER):
+    """
+    The entry point to the minikube class. Sends calls appropriately to set
+    up minikube.
+    :param image_transfer: how images get into the node, see IMAGE_TRANSFER.
+    """
+    if platform.machine().lower() not in ("amd64", "x86_64"):
+        raise ValueError("Requires 64-bit")
+    # The cluster is reached through the API client, so only the tools the
+    # image transfer runs are needed: "load" builds against a local docker
+    tools = [MINIKUBE_EXECUTABLE] + (["docker"] if image_transfer == "load" else [])
+    TOOLCHAIN.discover(tools)
+    missing = [tool for tool in tools if not TOOLCHAIN.available(tool)]
+    if missing:
+        raise ValueError("Could not find %s, run aimmo_setup.py first" % ", ".join(missing))
+    os.environ["MINIKUBE_PATH"] = MINIKUBE_EXECUTABLE
+    wait_for_teardown()
+
+    # We assume the minikube was started with a profile called "agones"
+    load_kube_config(context="agones")
+    # Start listing now so the cache is warm by the time the pods restart
+    cluster_cache()
+
+    # The images build while the roles are applied
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        roles = executor.submit(create_roles)
+        update_game_servers(build_target, image_transfer)
+        roles.result()
+    atexit.register(delete_components_on_exit)
+    print("Cluster ready")
+[7:08 PM, 5/19/2024] Aaron Joel Cse Rec: from _future_ import absolute_import
+
+import atexit
+import glob
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+
+from .shell_api import (
+    CACHE_DIR,
+    HASH_IGNORE,
+    file_sha256,
+    hash_tree,
+    is_fresh,
+    log,
+    mark_fresh,
+    Supervisor,
+    output_to,
+    run_command,
+    run_graph,
+    watch_changes,
+)
+
+ROOT_DIR_LOCATION = os.path.abspath(os.path.dirname((os.path.dirname(_file_))))
 
 _MANAGE_PY = os.path.join(ROOT_DIR_LOCATION, "example_project", "manage.py")
 _FRONTEND_BUNDLER_JS = os.path.join(ROOT_DIR_LOCATION, "game_frontend", "djangoBundler.js")
+_BUILD_WORKER_WHEEL_SH = os.path.join(ROOT_DIR_LOCATION, "aimmo_runner", "build_worker_wheel.sh")
 
-PROCESSES = []
+# Everything the worker wheel is built from
+WORKER_SOURCES = [os.path.join(ROOT_DIR_LOCATION, "aimmo-game-worker"), _BUILD_WORKER_WHEEL_SH]
+# The wheels build_worker_wheel.sh produces
+WORKER_WHEELS = os.environ.get(
+    "AIMMO_WORKER_WHEELS", os.path.join(ROOT_DIR_LOCATION, "aimmo-game-worker", "dist", "*.whl")
+)
+# The distribution `pip install -e` installs, and the files that decide what goes into it
+PACKAGE_NAME = "aimmo"
+PACKAGE_METADATA = [
+    os.path.join(ROOT_DIR_LOCATION, name) for name in ("setup.py", "setup.cfg", "pyproject.toml", "MANIFEST.in")
+]
+
+# Maximum number of startup stages run at the same time, and where each stage's output goes
+STAGE_WORKERS = int(os.environ.get("AIMMO_RUNNER_WORKERS", 4))
+STAGE_LOG_DIR = os.path.join(ROOT_DIR_LOCATION, ".runner-logs")
+# Lines of a failed stage's log printed to the terminal
+STAGE_LOG_TAIL = 40
+
+# Content hashes of the files collect_static copied, kept inside STATIC_ROOT
+STATIC_MANIFEST = ".collect-manifest.json"
+
+# Production frontend bundles are cached by a hash of the frontend sources and NODE_ENV
+FRONTEND_SOURCES = [os.path.join(ROOT_DIR_LOCATION, "game_frontend")]
+FRONTEND_IGNORE = HASH_IGNORE + [".cache", ".parcel-cache"]
+FRONTEND_BUNDLE_DIR = os.path.join(ROOT_DIR_LOCATION, "aimmo", "static", "react")
+FRONTEND_CACHE = os.path.join(CACHE_DIR, "frontend")
+FRONTEND_CACHE_ENTRIES = 5
+
+# runserver's port, and how long run() waits for it and the fleet to be ready.
+# READY is set and READY_FILE written once both are, so scripts can wait on
+# the file instead of sleeping
+SERVER_PORT = 8000
+READY_TIMEOUT = int(os.environ.get("AIMMO_READY_TIMEOUT", 600))
+READY_FILE = os.path.join(STAGE_LOG_DIR, "ready")
+READY = threading.Event()
+# Environment of the processes that use the cluster
+MINIKUBE_MODE_ENV = {"AIMMO_MODE": "minikube"}
+
+# Source trees --watch follows, mapped to what a change under each of them needs
+WATCH_PATHS = {
+    os.path.join(ROOT_DIR_LOCATION, "aimmo-game-worker"): "worker",
+    _BUILD_WORKER_WHEEL_SH: "worker",
+    os.path.join(ROOT_DIR_LOCATION, "aimmo-game"): "game",
+    os.path.join(ROOT_DIR_LOCATION, "aimmo"): "django",
+    os.path.join(ROOT_DIR_LOCATION, "example_project"): "django",
+}
+# Static files are served from source and the bundler watches the frontend itself
+WATCH_IGNORE = HASH_IGNORE + ["static", "*.sqlite3", "*.log", ".runner-logs", ".runner-cache"]
+
+# Long running children, restarted when they crash and sampled for CPU and memory use
+PROCESSES = Supervisor(telemetry_path=os.path.join(STAGE_LOG_DIR, "processes.jsonl"))
+
+
+def _process_log(name, capture_output):
+    # Captured output goes to a log per process rather than being thrown away
+    return os.path.join(STAGE_LOG_DIR, "%s.log" % name) if capture_output else None
 
 
 def create_superuser_if_missing(username, password):
@@ -753,40 +2086,358 @@ def create_superuser_if_missing(username, password):
 
 
 def build_worker_package():
-    run_command([os.path.join(ROOT_DIR_LOCATION, "aimmo_runner", "build_worker_wheel.sh")], capture_output=True)
+    """
+    Build the worker wheel, unless its sources are unchanged since the last
+    successful build and the wheel it produced is still there, unmodified.
+    Leaving the wheel untouched also keeps the images that contain it from
+    being rebuilt.
+    :return: True if the wheel was rebuilt, False if the cached one was used.
+    """
+    sources = hash_tree(WORKER_SOURCES)
+    wheels = sorted(glob.glob(WORKER_WHEELS))
+    if wheels and is_fresh("worker_wheel", "%s:%s" % (sources, hash_tree(wheels))):
+        log("Worker package unchanged, using the cached wheel")
+        return False
+
+    run_command([_BUILD_WORKER_WHEEL_SH], capture_output=True)
+    wheels = sorted(glob.glob(WORKER_WHEELS))
+    if wheels:
+        mark_fresh("worker_wheel", "%s:%s" % (sources, hash_tree(wheels)))
+    else:
+        log("No wheel matches %s, the worker package will be rebuilt every time" % WORKER_WHEELS)
+    log("Built the worker package")
+    return True
 
 
 def build_frontend(using_cypress, capture_output):
     if using_cypress:
-        run_command(["node", _FRONTEND_BUNDLER_JS], capture_output=capture_output)
+        build_frontend_bundle(capture_output)
     else:
-        frontend_bundler = run_command_async(["node", _FRONTEND_BUNDLER_JS], capture_output=capture_output)
-        PROCESSES.append(frontend_bundler)
+        PROCESSES.start(
+            "frontend_bundler",
+            ["node", _FRONTEND_BUNDLER_JS],
+            log_path=_process_log("frontend_bundler", capture_output),
+        )
+
+
+def build_frontend_bundle(capture_output):
+    """
+    Build the production frontend bundle, or restore it from FRONTEND_CACHE if
+    one was already built from identical sources, lockfile and NODE_ENV.
+    """
+    key = "%s-%s" % (os.environ.get("NODE_ENV", ""), hash_tree(FRONTEND_SOURCES, FRONTEND_IGNORE))
+    cached_bundle = os.path.join(FRONTEND_CACHE, key)
 
+    if os.path.isdir(cached_bundle):
+        _replace_tree(cached_bundle, FRONTEND_BUNDLE_DIR)
+        log("Frontend unchanged, restored the cached bundle")
+        return
 
-def start_game_servers(build_target, server_args, capture_output: bool):
+    run_command(["node", _FRONTEND_BUNDLER_JS], capture_output=capture_output)
+
+    if os.path.isdir(FRONTEND_BUNDLE_DIR):
+        try:
+            _replace_tree(FRONTEND_BUNDLE_DIR, cached_bundle)
+            _prune_frontend_cache()
+        except OSError as e:
+            # Another run sharing the cache may be storing the same bundle
+            log("Could not cache the frontend bundle: %s" % e)
+
+
+def _replace_tree(source, dest):
+    # Copy next to dest first, so dest is only ever missing for the length of a rename
+    temp_dest = "%s.%d.tmp" % (dest, os.getpid())
+    shutil.rmtree(temp_dest, ignore_errors=True)
+    shutil.copytree(source, temp_dest)
+    shutil.rmtree(dest, ignore_errors=True)
+    os.rename(temp_dest, dest)
+
+
+def _prune_frontend_cache():
+    bundles = [os.path.join(FRONTEND_CACHE, name) for name in os.listdir(FRONTEND_CACHE)]
+    bundles.sort(key=os.path.getmtime, reverse=True)
+    for bundle in bundles[FRONTEND_CACHE_ENTRIES:]:
+        shutil.rmtree(bundle, ignore_errors=True)
+
+
+def install_package(capture_output):
+    """
+    `pip install -e` the project, unless the package metadata and interpreter
+    are the same as for the last successful install and the package is still
+    installed, which it isn't in a virtualenv recreated at the same path.
+    """
+    from importlib.metadata import PackageNotFoundError, distribution
+
+    fingerprint = "%s:%s" % (sys.executable, hash_tree([path for path in PACKAGE_METADATA if os.path.exists(path)]))
+    try:
+        distribution(PACKAGE_NAME)
+        installed = True
+    except PackageNotFoundError:
+        installed = False
+    if installed and is_fresh("pip_install", fingerprint):
+        log("Package metadata unchanged, skipping pip install")
+        return
+
+    run_command(["pip", "install", "-e", ROOT_DIR_LOCATION], capture_output=capture_output)
+    mark_fresh("pip_install", fingerprint)
+
+
+def migrate(capture_output):
+    """
+    Run migrate only if there are unapplied migrations. The plan is checked in
+    this process, since Django is already set up, instead of paying for a new one.
+    """
+    from django.db import DEFAULT_DB_ALIAS, connections
+    from django.db.migrations.executor import MigrationExecutor
+
+    connection = connections[DEFAULT_DB_ALIAS]
+    try:
+        executor = MigrationExecutor(connection)
+        plan = executor.migration_plan(executor.loader.graph.leaf_nodes())
+    finally:
+        connection.close()
+
+    if not plan:
+        log("No migrations to apply")
+        return
+
+    run_command(["python", _MANAGE_PY, "migrate", "--noinput"], capture_output=capture_output)
+
+
+def collect_static(capture_output):
+    """
+    Incremental replacement for `collectstatic --noinput --clear`. A manifest of
+    content hashes in STATIC_ROOT records what was collected last time, so only
+    changed files are copied and only files that no longer have a source are
+    removed. Files whose size and mtime haven't changed aren't even re-hashed.
+    Storages that post-process files (e.g. hashed names) fall back to collectstatic.
+    """
+    from django.apps import apps
+    from django.conf import settings
+    from django.contrib.staticfiles import finders
+    from django.contrib.staticfiles.storage import StaticFilesStorage, staticfiles_storage
+
+    if staticfiles_storage.__class__ is not StaticFilesStorage:
+        run_command(["python", _MANAGE_PY, "collectstatic", "--noinput", "--clear"], capture_output=capture_output)
+        return
+
+    static_root = settings.STATIC_ROOT
+    manifest_path = os.path.join(static_root, STATIC_MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        manifest = None
+
+    # Like collectstatic, the first finder to provide a path wins
+    sources = {}
+    ignore_patterns = apps.get_app_config("staticfiles").ignore_patterns
+    for finder in finders.get_finders():
+        for path, storage in finder.list(ignore_patterns):
+            prefix = getattr(storage, "prefix", None)
+            sources.setdefault(os.path.join(prefix, path) if prefix else path, storage.path(path))
+
+    new_manifest = {}
+    copied = 0
+    for path, source in sources.items():
+        source_stat = os.stat(source)
+        entry = (manifest or {}).get(path)
+        dest = os.path.join(static_root, path)
+        unchanged = entry and entry["size"] == source_stat.st_size and entry["mtime"] == source_stat.st_mtime_ns
+
+        if not unchanged or not os.path.exists(dest):
+            digest = file_sha256(source)
+            if not (entry and entry["sha256"] == digest and os.path.exists(dest)):
+                _copy_file(source, dest)
+                copied += 1
+            entry = {"size": source_stat.st_size, "mtime": source_stat.st_mtime_ns, "sha256": digest}
+        new_manifest[path] = entry
+
+    if manifest is None:
+        # Nothing is known about what's in STATIC_ROOT yet, so clear out anything without a source
+        orphans = []
+        for directory, _, filenames in os.walk(static_root):
+            for filename in filenames:
+                orphans.append(os.path.relpath(os.path.join(directory, filename), static_root))
+    else:
+        orphans = list(manifest)
+    orphans = [path for path in orphans if path not in new_manifest and path != STATIC_MANIFEST]
+    for path in orphans:
+        try:
+            os.remove(os.path.join(static_root, path))
+        except OSError:
+            pass
+
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(new_manifest, f)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    log(
+        "Collected static files: %d copied, %d removed, %d unchanged"
+        % (copied, len(orphans), len(new_manifest) - copied)
+    )
+
+
+def _copy_file(source, dest):
+    directory = os.path.dirname(dest)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    shutil.copy2(source, dest + ".tmp")
+    os.replace(dest + ".tmp", dest)
+
+
+def start_cluster(build_target):
     parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(_file_)))
     sys.path.append(os.path.join(parent_dir, "aimmo_runner"))
-    os.chdir(ROOT_DIR_LOCATION)
 
     # Import minikube here, so we can install the dependencies first
     from aimmo_runner import minikube
 
+    # Returns once the fleet has all its replicas ready
     minikube.start(build_target=build_target)
 
-    server_args.append("0.0.0.0:8000")
-    os.environ["AIMMO_MODE"] = "minikube"
 
+def start_game_servers(capture_output: bool):
+    # The fleet is already ready, so every running game's allocation is
+    # served straight away rather than waiting on a cold game server
     run_command(
         ["python", _MANAGE_PY, "start_game_servers_for_running_games"],
         capture_output=capture_output,
+        env=MINIKUBE_MODE_ENV,
     )
 
 
-def run(server_wait=True, using_cypress=False, capture_output=False, test_env=False, build_target=None):
-    logging.basicConfig()
+def start_server(server_args, server_env, capture_output, timeout=READY_TIMEOUT):
+    server = PROCESSES.start(
+        "runserver",
+        ["python", _MANAGE_PY, "runserver"] + server_args,
+        env=server_env,
+        log_path=_process_log("runserver", capture_output),
+    )
+    wait_for_server(server, timeout=timeout)
+    return server
+
+
+def wait_for_server(server, port=SERVER_PORT, timeout=READY_TIMEOUT):
+    """
+    Block until runserver answers an HTTP request on port. Any response counts,
+    error statuses included.
+    :raise RuntimeError: if the server exits or doesn't answer within timeout seconds.
+    """
+    from urllib.error import HTTPError, URLError
+    from urllib.request import urlopen
+
+    url = "http://127.0.0.1:%d/" % port
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("runserver exited with status %d" % server.returncode)
+        try:
+            urlopen(url, timeout=5).close()
+            return
+        except HTTPError:
+            return
+        except (URLError, IOError, OSError):
+            time.sleep(0.2)
+    raise RuntimeError("runserver did not answer on port %d within %ds" % (port, timeout))
 
-    build_worker_package()
+
+def wait_until_ready(timeout=None):
+    """
+    Block until the server answers and, unless it isn't used, the fleet has
+    ready replicas.
+    :return: whether that happened within timeout seconds.
+    """
+    return READY.wait(timeout)
+
+
+def _mark_ready(fleet_started):
+    if fleet_started:
+        from aimmo_runner import minikube
+
+        # Games started since the cluster stage have allocated some of the
+        # game servers, so this only asks for one still free to join
+        def has_ready_replicas(cache):
+            fleet = cache.get("fleets", "aimmo-game")
+            return fleet is not None and fleet.get("status", {}).get("readyReplicas", 0) > 0
+
+        if not minikube.cluster_cache().wait_for(has_ready_replicas, READY_TIMEOUT):
+            raise RuntimeError("The aimmo-game fleet has no ready replicas")
+    with open(READY_FILE, "w") as f:
+        f.write("%f\n" % time.time())
+    READY.set()
+    log("Ready")
+
+
+def watch(server, build_target, using_cypress, capture_output):
+    """
+    Bring each batch of source changes into the running project with the least
+    work, until interrupted. Worker changes rebuild the wheel, then the images
+    and fleet. Game changes rebuild the images and fleet, where the images are
+    only built and the fleet only rolls out if their build contexts changed.
+    Django changes restart runserver, after migrating if a migration changed.
+    """
+    log("Watching for changes")
+    for changed in watch_changes(list(WATCH_PATHS), WATCH_IGNORE):
+        actions = set(_watch_action(path) for path in changed)
+        start = time.time()
+        log("%d files changed, updating %s" % (len(changed), ", ".join(sorted(actions))))
+        try:
+            if "worker" in actions:
+                build_worker_package()
+            if actions & {"worker", "game"} and not using_cypress:
+                from aimmo_runner import minikube
+
+                minikube.update_game_servers(build_target)
+            if "migrations" in actions:
+                migrate(capture_output)
+            if actions & {"django", "migrations"}:
+                PROCESSES.restart(server)
+                wait_for_server(server)
+        except Exception as e:
+            log("Update failed, waiting for the next change: %s" % e)
+            continue
+        log("Updated in %.1fs" % (time.time() - start))
+
+
+def _watch_action(path):
+    root = max((root for root in WATCH_PATHS if path == root or path.startswith(root + os.sep)), key=len)
+    if WATCH_PATHS[root] == "django" and "migrations" in path.split(os.sep):
+        return "migrations"
+    return WATCH_PATHS[root]
+
+
+def run_stages(stages, max_workers=STAGE_WORKERS):
+    """
+    Run startup stages concurrently as a dependency graph. Each stage's command
+    output goes to its own log in STAGE_LOG_DIR, and the tail of that log is
+    printed if the stage fails.
+    :param stages: stage names mapped to (names of stages it depends on, function to run).
+    """
+
+    def run_stage(name):
+        log_path = os.path.join(STAGE_LOG_DIR, "%s.log" % name)
+        start = time.time()
+        log("[%s] started" % name)
+        try:
+            with output_to(log_path):
+                stages[name][1]()
+        except Exception:
+            log("[%s] failed after %.1fs, last lines of %s:" % (name, time.time() - start, log_path))
+            with open(log_path) as f:
+                sys.stderr.writelines(f.readlines()[-STAGE_LOG_TAIL:])
+            raise
+        log("[%s] finished in %.1fs" % (name, time.time() - start))
+
+    run_graph(dict((name, dependencies) for name, (dependencies, _) in stages.items()), run_stage, max_workers)
+
+
+def run(server_wait=True, using_cypress=False, capture_output=False, test_env=False, build_target=None, watch_mode=False):
+    # Django is only imported once the runner is actually running, see run.py --check-startup
+    import django
+    from django.conf import settings
+
+    logging.basicConfig()
 
     if test_env:
         os.environ.setdefault("DJANGO_SETTINGS_MODULE", "test_settings")
@@ -802,29 +2453,68 @@ def run(server_wait=True, using_cypress=False, capture_output=False, test_env=Fa
 
     os.environ["NODE_ENV"] = "development" if settings.DEBUG else "production"
 
-    build_frontend(using_cypress, capture_output)
-
-    run_command(["pip", "install", "-e", ROOT_DIR_LOCATION], capture_output=capture_output)
+    server_args = []
+    server_env = {"SERVER_ENV": "local"}
+    READY.clear()
+    if os.path.exists(READY_FILE):
+        os.remove(READY_FILE)
+    os.chdir(ROOT_DIR_LOCATION)
+    if watch_mode:
+        # The watcher restarts runserver itself, only for changes that need it
+        server_args.append("--noreload")
+
+    # Each stage is mapped to the stages that must finish before it can start
+    stages = {
+        "build_worker_package": ([], build_worker_package),
+        "build_frontend": ([], lambda: build_frontend(using_cypress, capture_output)),
+        "pip_install": ([], lambda: install_package(capture_output)),
+    }
 
     if not test_env:
-        run_command(["python", _MANAGE_PY, "migrate", "--noinput"], capture_output=capture_output)
-        run_command(["python", _MANAGE_PY, "collectstatic", "--noinput", "--clear"], capture_output=capture_output)
+        stages["migrate"] = (["pip_install"], lambda: migrate(capture_output))
+        # In cypress mode the bundle is built up front and has to be collected
+        stages["collectstatic"] = (["pip_install", "build_frontend"], lambda: collect_static(capture_output))
 
-    server_args = []
     if not using_cypress:
-        start_game_servers(build_target, server_args, capture_output)
+        # Only the processes that talk to the cluster run in minikube mode,
+        # so migrate and collectstatic don't load its settings early
+        server_env.update(MINIKUBE_MODE_ENV)
+        server_args.append("0.0.0.0:%d" % SERVER_PORT)
+        stages["start_cluster"] = (["build_worker_package", "pip_install"], lambda: start_cluster(build_target))
+        stages["start_game_servers"] = (
+            ["start_cluster"] + ([] if test_env else ["migrate"]),
+            lambda: start_game_servers(capture_output),
+        )
 
-    os.environ["SERVER_ENV"] = "local"
-    server = run_command_async(["python", _MANAGE_PY, "runserver"] + server_args, capture_output=capture_output)
-    PROCESSES.append(server)
+    # runserver comes up while the cluster is still starting
+    servers = []
+    stages["runserver"] = (
+        [name for name in ("pip_install", "migrate", "collectstatic") if name in stages],
+        lambda: servers.append(start_server(server_args, server_env, capture_output)),
+    )
 
-    if server_wait:
+    atexit.register(PROCESSES.stop)
+    run_stages(stages)
+    _mark_ready(fleet_started=not using_cypress)
+    server = servers[0]
+
+    if watch_mode:
         try:
-            game.wait()
-        except NameError:
+            watch(server, build_target, using_cypress, capture_output)
+        except KeyboardInterrupt:
             pass
+        finally:
+            PROCESSES.stop()
+    elif server_wait:
+        try:
+            try:
+                game.wait()
+            except NameError:
+                pass
 
-        server.wait()
+            server.wait()
+        finally:
+            PROCESSES.stop()
 
     return PROCESSES
 coding: utf-8 --
@@ -850,17 +2540,28 @@ setup(
 )
 
 Import errno
+import fnmatch
+import hashlib
+import json
 import os
 import platform
+import re
+import select
+import shutil
+import signal
 import stat
+import struct
 import subprocess
 import sys
-from subprocess import CalledProcessError
+import threading
+import time
+import weakref
+from collections import namedtuple
+from contextlib import contextmanager
+from subprocess import STDOUT, CalledProcessError, TimeoutExpired
 
-try:
-    from urllib.request import urlretrieve, urlopen
-except ImportError:
-    from urllib import urlretrieve, urlopen
+# asyncio, concurrent.futures, ctypes and urllib.request are imported where
+# they're used, which keeps importing this module cheap for run.py
 
 BASE_DIR = os.path.abspath(os.path.dirname(os.path.dirname(_file_)))
 TEST_BIN = os.path.join(BASE_DIR, "test-bin")
@@ -870,24 +2571,114 @@ KUBECTL = os.path.join(TEST_BIN, "kubectl%s" % FILE_SUFFIX)
 MINIKUBE = os.path.join(TEST_BIN, "minikube%s" % FILE_SUFFIX)
 FNULL = open(os.devnull, "w")
 
+CACHE_DIR = os.environ.get("AIMMO_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "aimmo"))
+# "latest" version lookups are reused for this many seconds
+VERSION_CACHE = os.path.join(CACHE_DIR, "versions.json")
+VERSION_CACHE_TTL = int(os.environ.get("AIMMO_VERSION_CACHE_TTL", 6 * 60 * 60))
+# When set, resolved versions are pinned in this file and never looked up again
+VERSION_LOCKFILE = os.environ.get("AIMMO_VERSION_LOCKFILE")
+NETWORK_TIMEOUT = 10
+# Downloaded binaries, stored by the SHA-256 of their content
+DOWNLOAD_CACHE = os.path.join(CACHE_DIR, "downloads")
+
+# Arguments that make each tool print its version
+TOOL_VERSION_ARGS = {
+    "node": ["--version"],
+    "yarn": ["--version"],
+    "pipenv": ["--version"],
+    "docker": ["-v"],
+    "minikube": ["version"],
+    "kubectl": ["version", "--client"],
+    "helm": ["version", "--short"],
+    "pip": ["--version"],
+    "sqlite3": ["-version"],
+}
+TOOL_PROBE_TIMEOUT = 30
+
+# Where run_command sends its output on this thread, see output_to
+_OUTPUT = threading.local()
+
+# Commands run through run_command_aio at the same time, per event loop
+COMMAND_CONCURRENCY = int(os.environ.get("AIMMO_COMMAND_CONCURRENCY", os.cpu_count() or 4))
+# Longest output line run_command_aio reads, in bytes
+COMMAND_LINE_LIMIT = 1024 * 1024
+_command_semaphores = weakref.WeakKeyDictionary()
+_command_env = None
+_command_env_lock = threading.Lock()
+
+# Fingerprints of the last successful incremental builds in this checkout
+BUILD_STATE = os.path.join(BASE_DIR, ".runner-cache", "fingerprints.json")
+# Names skipped when hashing source trees
+HASH_IGNORE = ["__pycache__", "*.pyc", ".git", "*.egg-info", "build", "dist", "node_modules", ".DS_Store"]
+
+# Crashed supervised processes are restarted after a delay that doubles from
+# the first to the second value, resets once a process has stayed up for
+# SUPERVISOR_STABLE_AFTER seconds, and is given up on after this many restarts
+SUPERVISOR_BACKOFF = (1.0, 30.0)
+SUPERVISOR_STABLE_AFTER = 60
+SUPERVISOR_MAX_RESTARTS = int(os.environ.get("AIMMO_SUPERVISOR_MAX_RESTARTS", 5))
+# Seconds between health checks and between CPU/RSS samples of each process tree
+SUPERVISOR_INTERVAL = 0.5
+SAMPLE_INTERVAL = int(os.environ.get("AIMMO_SAMPLE_INTERVAL", 5))
+# A process is reported when it stays above this CPU percentage for
+# SAMPLE_CPU_STREAK samples, or its RSS grows by SAMPLE_RSS_GROWTH bytes
+SAMPLE_CPU_WARNING = 90.0
+SAMPLE_CPU_STREAK = 6
+SAMPLE_RSS_GROWTH = 256 * 1024 * 1024
+# Seconds shutdown waits after asking processes to terminate before killing them
+SHUTDOWN_DEADLINE = 10
+
+# watch_changes waits for this many seconds without a change before reporting
+# a batch, and checks modification times this often where inotify isn't available
+WATCH_DEBOUNCE = float(os.environ.get("AIMMO_WATCH_DEBOUNCE", 0.5))
+WATCH_POLL_INTERVAL = 1.0
+
+_VERSION_LOCK = threading.Lock()
+
 
 def log(message):
     sys.stderr.write(message + "\n")
 
 
-def run_command(args, capture_output=False):
+def urlopen(url, timeout):
+    # urllib.request pulls in http.client, ssl and email
+    from urllib.request import urlopen
+
+    return urlopen(url, timeout=timeout)
+
+
+def run_command(args, capture_output=False, env=None):
+    # env is added to a copy of this process's environment
+    env = dict(os.environ, **env) if env else None
     try:
         if capture_output:
-            return subprocess.check_output(args)
+            return subprocess.check_output(args, env=env)
         else:
-            subprocess.check_call(args)
+            output = getattr(_OUTPUT, "file", None)
+            subprocess.check_call(args, stdout=output, stderr=STDOUT if output else None, env=env)
     except CalledProcessError as e:
         log("Command failed with exit status %d: %s" % (e.returncode, " ".join(args)))
         raise
 
 
-def run_command_async(args, capture_output=False):
-    env = os.environ.copy()
+@contextmanager
+def output_to(path):
+    # Send the output of run_command calls made on this thread to a log file
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    previous = getattr(_OUTPUT, "file", None)
+    with open(path, "w") as f:
+        _OUTPUT.file = f
+        try:
+            yield f
+        finally:
+            _OUTPUT.file = previous
+
+
+def run_command_async(args, capture_output=False, env=None):
+    # env is added to a copy of this process's environment
+    env = dict(os.environ, **(env or {}))
     if capture_output is True:
         p = subprocess.Popen(args, stdout=FNULL, stderr=subprocess.STDOUT, env=env)
     else:
@@ -895,18 +2686,715 @@ def run_command_async(args, capture_output=False):
     return p
 
 
+CommandResult = namedtuple("CommandResult", ["args", "returncode", "output"])
+
+
+def command_env(env=None):
+    """
+    The environment commands run through run_command_aio get. It's one snapshot
+    of os.environ shared by every command, with env added to a copy of it when given.
+    """
+    global _command_env
+    with _command_env_lock:
+        if _command_env is None:
+            _command_env = dict(os.environ)
+        return dict(_command_env, **env) if env else _command_env
+
+
+def refresh_command_env():
+    # Take the snapshot again, after this process has changed os.environ
+    global _command_env
+    with _command_env_lock:
+        _command_env = None
+
+
+async def run_command_aio(args, timeout=None, on_line=None, capture_output=False, env=None, check=True):
+    """
+    Run a command without blocking the event loop. At most COMMAND_CONCURRENCY
+    commands run at once on each loop, the rest wait their turn.
+    :param timeout: seconds after which the command is killed and TimeoutExpired raised.
+    :param on_line: called with each line of output, stdout and stderr combined, as it's printed.
+    :param capture_output: keep the output and return it in the result.
+    :param env: added to the shared environment snapshot, see command_env.
+    :param check: raise CalledProcessError if the command exits with a non-zero status.
+    :return: a CommandResult, whose output is None unless capture_output is set.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    if loop not in _command_semaphores:
+        _command_semaphores[loop] = asyncio.Semaphore(COMMAND_CONCURRENCY)
+
+    async with _command_semaphores[loop]:
+        # Without a reader, output goes where run_command's would
+        piped = on_line is not None or capture_output
+        output = None if piped else getattr(_OUTPUT, "file", None)
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdout=subprocess.PIPE if piped else output,
+            stderr=STDOUT if piped or output else None,
+            env=command_env(env),
+            limit=COMMAND_LINE_LIMIT,
+        )
+        lines = []
+
+        async def finish():
+            if piped:
+                async for line in process.stdout:
+                    line = line.decode("utf-8", "replace").rstrip("\r\n")
+                    if capture_output:
+                        lines.append(line)
+                    if on_line is not None:
+                        on_line(line)
+            return await process.wait()
+
+        try:
+            returncode = await asyncio.wait_for(finish(), timeout)
+        except asyncio.TimeoutError:
+            log("Command timed out after %ss: %s" % (timeout, " ".join(args)))
+            raise TimeoutExpired(args, timeout)
+        finally:
+            # Covers timeouts and cancellation alike
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
+    captured = "\n".join(lines) if capture_output else None
+    if check and returncode != 0:
+        log("Command failed with exit status %d: %s" % (returncode, " ".join(args)))
+        raise CalledProcessError(returncode, args, captured)
+    return CommandResult(args, returncode, captured)
+
+
+def run_concurrently(*awaitables):
+    """
+    Run awaitables, such as run_command_aio calls, together on a new event loop
+    from synchronous code.
+    :return: their results, in the order they were given.
+    """
+    import asyncio
+
+    async def gather():
+        return await asyncio.gather(*awaitables)
+
+    return asyncio.run(gather())
+
+
+class SupervisedProcess(object):
+    """
+    A child process kept running by a Supervisor. The Popen handle behind it
+    changes when it's restarted; poll(), wait() and returncode only report an
+    exit once the supervisor has given up on it or it has been signalled
+    through send_signal(), terminate() or kill(), which it isn't restarted after.
+    """
+
+    def __init__(self, supervisor, name, args, env, log_path, restart):
+        self.name = name
+        self.args = args
+        self.env = env
+        self.log_path = log_path
+        self.restart = restart
+        self.process = None
+        self.status = "starting"
+        self.returncode = None
+        self.restarts = 0
+        self.started = None
+        self.restart_at = None
+        self.cpu_percent = 0.0
+        self.rss = 0
+        self.peak_rss = 0
+        self._supervisor = supervisor
+        self._tree = {}
+        self._first_rss = None
+        self._busy_samples = 0
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process else None
+
+    def poll(self):
+        if self.status == "stopped" and self.returncode is None and self.process:
+            self.returncode = self.process.poll()
+        return self.returncode if self.status in ("exited", "failed", "stopped") else None
+
+    def wait(self, timeout=None):
+        with self._supervisor._condition:
+            self._supervisor._condition.wait_for(lambda: self.poll() is not None or self.status == "stopped", timeout)
+        if self.status == "stopped" and self.returncode is None and self.process:
+            try:
+                self.process.wait(timeout)
+            except TimeoutExpired:
+                pass
+        return self.poll()
+
+    def send_signal(self, sig):
+        with self._supervisor._condition:
+            # Stopped before it's signalled, so the monitor doesn't take the exit for a crash
+            self.status = "stopped"
+            self.restart_at = None
+            self._supervisor._condition.notify_all()
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL if hasattr(signal, "SIGKILL") else signal.SIGTERM)
+
+
+class Supervisor(object):
+    """
+    Starts child processes, restarts the ones that crash with a backoff and
+    shuts them all down together. A monitor thread checks their health and
+    samples the CPU and RSS of each process tree with psutil, when it's
+    installed, appending the samples to telemetry_path as JSON lines.
+    Iterating over it gives the SupervisedProcess of each child.
+    """
+
+    def __init__(self, telemetry_path=None):
+        self.telemetry_path = telemetry_path
+        self._children = []
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._monitor = None
+        self._last_sample = 0
+
+    def __iter__(self):
+        with self._condition:
+            return iter(list(self._children))
+
+    def __len__(self):
+        with self._condition:
+            return len(self._children)
+
+    def start(self, name, args, env=None, log_path=None, restart=True):
+        """
+        :param env: added to a copy of this process's environment.
+        :param log_path: file the process's output is appended to, instead of the terminal.
+        :param restart: whether to start it again when it exits with a non-zero status.
+        """
+        child = SupervisedProcess(self, name, args, env, log_path, restart)
+        with self._condition:
+            self._stopping = False
+            self._spawn(child)
+            self._children.append(child)
+            if self._monitor is None or not self._monitor.is_alive():
+                self._monitor = threading.Thread(target=self._watch, name="supervisor")
+                self._monitor.daemon = True
+                self._monitor.start()
+        return child
+
+    def health(self):
+        # Name of each process mapped to its status, restart count and last sample
+        with self._condition:
+            return dict(
+                (
+                    child.name,
+                    {
+                        "status": child.status,
+                        "pid": child.pid,
+                        "returncode": child.returncode,
+                        "restarts": child.restarts,
+                        "cpu_percent": child.cpu_percent,
+                        "rss": child.rss,
+                        "peak_rss": child.peak_rss,
+                    },
+                )
+                for child in self._children
+            )
+
+    def stop(self, deadline=SHUTDOWN_DEADLINE):
+        """
+        Terminate every process at once, along with the processes they started,
+        then kill whatever is left after deadline seconds.
+        """
+        with self._condition:
+            self._stopping = True
+            running = [child for child in self._children if child.status == "running"]
+            for child in self._children:
+                if child.status == "backoff":
+                    child.status = "stopped"
+            self._condition.notify_all()
+        _terminate(running, deadline)
+        with self._condition:
+            for child in running:
+                child.status = "stopped"
+                child.returncode = child.process.returncode
+            self._condition.notify_all()
+
+    def restart(self, child, deadline=SHUTDOWN_DEADLINE):
+        """
+        Stop a process and start it again straight away, e.g. to pick up changed code.
+        """
+        with self._condition:
+            # Keeps the monitor from taking the exit for a crash
+            child.status = "restarting"
+        _terminate([child], deadline)
+        with self._condition:
+            self._spawn(child)
+            self._condition.notify_all()
+
+    def _spawn(self, child):
+        output = open(child.log_path, "a") if child.log_path else None
+        try:
+            child.process = subprocess.Popen(
+                child.args,
+                stdout=output,
+                stderr=STDOUT if output else None,
+                env=dict(os.environ, **(child.env or {})),
+            )
+        finally:
+            if output:
+                output.close()
+        child.status = "running"
+        child.started = time.time()
+        child.restart_at = None
+        child._tree = {}
+
+    def _watch(self):
+        while True:
+            with self._condition:
+                if self._stopping:
+                    return
+                for child in self._children:
+                    self._check(child)
+                self._condition.notify_all()
+            if time.time() - self._last_sample >= SAMPLE_INTERVAL:
+                self._last_sample = time.time()
+                self._sample()
+            time.sleep(SUPERVISOR_INTERVAL)
+
+    def _check(self, child):
+        now = time.time()
+        if child.status == "backoff" and now >= child.restart_at:
+            log("Restarting %s (restart %d)" % (child.name, child.restarts))
+            self._spawn(child)
+            return
+        if child.status != "running" or child.process.poll() is None:
+            return
+
+        returncode = child.process.returncode
+        if returncode == 0 or not child.restart:
+            child.status = "exited" if returncode == 0 else "failed"
+            child.returncode = returncode
+            log("%s exited with status %d" % (child.name, returncode))
+            return
+
+        if now - child.started >= SUPERVISOR_STABLE_AFTER:
+            child.restarts = 0
+        if child.restarts >= SUPERVISOR_MAX_RESTARTS:
+            child.status = "failed"
+            child.returncode = returncode
+            log("%s exited with status %d, giving up after %d restarts" % (child.name, returncode, child.restarts))
+            return
+
+        first, maximum = SUPERVISOR_BACKOFF
+        delay = min(maximum, first * 2 ** child.restarts)
+        child.restarts += 1
+        child.status = "backoff"
+        child.restart_at = now + delay
+        log("%s exited with status %d, restarting in %.1fs" % (child.name, returncode, delay))
+
+    def _sample(self):
+        try:
+            import psutil
+        except ImportError:
+            return
+
+        with self._condition:
+            children = [child for child in self._children if child.status == "running"]
+        samples = []
+        for child in children:
+            try:
+                root = child._tree.get(child.pid) or psutil.Process(child.pid)
+                processes = [root] + root.children(recursive=True)
+            except psutil.Error:
+                continue
+            # Keep the same Process objects between samples, cpu_percent measures since the last call
+            tree = dict((process.pid, child._tree.get(process.pid, process)) for process in processes)
+            child._tree = tree
+            cpu_percent, rss = 0.0, 0
+            for process in tree.values():
+                try:
+                    cpu_percent += process.cpu_percent(None)
+                    rss += process.memory_info().rss
+                except psutil.Error:
+                    pass
+            self._record(child, cpu_percent, rss)
+            samples.append(
+                {"time": time.time(), "name": child.name, "pid": child.pid, "cpu_percent": cpu_percent, "rss": rss}
+            )
+
+        if self.telemetry_path and samples:
+            directory = os.path.dirname(self.telemetry_path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.telemetry_path, "a") as f:
+                f.writelines(json.dumps(sample, sort_keys=True) + "\n" for sample in samples)
+
+    def _record(self, child, cpu_percent, rss):
+        child.cpu_percent = cpu_percent
+        child.rss = rss
+        child.peak_rss = max(child.peak_rss, rss)
+        if child._first_rss is None:
+            child._first_rss = rss
+
+        child._busy_samples = child._busy_samples + 1 if cpu_percent >= SAMPLE_CPU_WARNING else 0
+        if child._busy_samples == SAMPLE_CPU_STREAK:
+            log("%s has used %.0f%% CPU for %ds" % (child.name, cpu_percent, SAMPLE_CPU_STREAK * SAMPLE_INTERVAL))
+        if rss - child._first_rss >= SAMPLE_RSS_GROWTH:
+            log("%s has grown to %.0fMB RSS" % (child.name, rss / 1024.0 / 1024))
+            child._first_rss = rss
+
+
+def _terminate(children, deadline):
+    # Terminate the children and everything they started, killing what's left after deadline seconds
+    descendants = [process for child in children for process in _descendants(child.pid)]
+    for process in [child.process for child in children] + descendants:
+        try:
+            process.terminate()
+        except Exception:
+            pass
+
+    end = time.time() + deadline
+    for child in children:
+        try:
+            child.process.wait(max(0, end - time.time()))
+        except subprocess.TimeoutExpired:
+            log("%s did not exit within %ds, killing it" % (child.name, deadline))
+            child.process.kill()
+            child.process.wait()
+    if descendants:
+        import psutil
+
+        _, alive = psutil.wait_procs(descendants, timeout=max(0, end - time.time()))
+        for process in alive:
+            try:
+                process.kill()
+            except psutil.Error:
+                pass
+
+
+def _descendants(pid):
+    # Every process under pid, or none when psutil isn't installed to find them
+    try:
+        import psutil
+
+        return psutil.Process(pid).children(recursive=True)
+    except Exception:
+        return []
+
+
 def binary_exists(filename):
     # Check if binary is callable on our path
+    return TOOLCHAIN.path(filename) is not None
+
+
+class Toolchain(object):
+    """
+    Paths and versions of the tools setup and the runner rely on. Each tool is
+    looked up on the PATH and its version command run at most once per process,
+    unless it is forgotten after being (re)installed.
+    """
+
+    def __init__(self, version_args=None):
+        self.version_args = TOOL_VERSION_ARGS if version_args is None else version_args
+        self._lock = threading.Lock()
+        self._tools = {}
+
+    def discover(self, names=None):
+        # Probe every tool not yet known in one concurrent pass
+        with self._lock:
+            names = [name for name in (names or self.version_args) if name not in self._tools]
+        if not names:
+            return
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            found = dict(zip(names, executor.map(self._probe, names)))
+        with self._lock:
+            for name, tool in found.items():
+                self._tools.setdefault(name, tool)
+
+    def path(self, name):
+        return self._get(name)["path"]
+
+    def version(self, name):
+        return self._get(name)["version"]
+
+    def available(self, name):
+        # Found on the PATH and, if it has a version command, that command succeeded
+        return self._get(name)["working"]
+
+    def forget(self, name):
+        with self._lock:
+            self._tools.pop(name, None)
+
+    def _get(self, name):
+        with self._lock:
+            tool = self._tools.get(name)
+        if tool is None:
+            tool = self._probe(name)
+            with self._lock:
+                tool = self._tools.setdefault(name, tool)
+        return tool
+
+    def _probe(self, name):
+        path = shutil.which(name)
+        tool = {"path": path, "version": None, "output": None, "working": path is not None}
+        if path is None or name not in self.version_args:
+            return tool
+
+        try:
+            output = subprocess.check_output(
+                [path] + self.version_args[name], stderr=subprocess.STDOUT, timeout=TOOL_PROBE_TIMEOUT
+            )
+        except (CalledProcessError, OSError, subprocess.TimeoutExpired):
+            tool["working"] = False
+            return tool
+
+        tool["output"] = output.decode("utf-8", "replace")
+        match = re.search(r"(\d+\.\d+(?:\.\d+)?)", tool["output"])
+        tool["version"] = match.group(1) if match else None
+        return tool
+
+
+TOOLCHAIN = Toolchain()
+
+
+def download_exec(url, dest, version=None, sha256=None, checksum_url=None):
+    install_exec(cached_download(url, version, sha256, checksum_url), dest)
+
+
+def install_exec(source, dest):
+    # Copy next to the destination first so the final rename is atomic
+    temp_dest = "%s.%d.tmp" % (dest, os.getpid())
+    shutil.copyfile(source, temp_dest)
+    make_exec(temp_dest)
+    os.replace(temp_dest, dest)
+    # Lookups of it by path or by name may have been cached before it existed
+    TOOLCHAIN.forget(dest)
+    TOOLCHAIN.forget(os.path.basename(dest))
+
+
+def cached_download(url, version=None, sha256=None, checksum_url=None):
+    """
+    Return the path of a local copy of url, only downloading it the first time
+    it is asked for with this version. checksum_url points at a published
+    SHA-256 to check a fresh download against.
+    """
+    key = hashlib.sha256(("%s\0%s" % (url, version or "")).encode("utf-8")).hexdigest()
+    index_path = os.path.join(DOWNLOAD_CACHE, "index.json")
+
+    digest = _read_json(index_path).get(key)
+    if digest and (sha256 is None or digest == sha256):
+        path = os.path.join(DOWNLOAD_CACHE, digest)
+        if os.path.isfile(path) and file_sha256(path) == digest:
+            return path
+
+    if sha256 is None and checksum_url:
+        sha256 = urlopen(checksum_url, timeout=NETWORK_TIMEOUT).read().decode("utf-8").split()[0]
+
+    if not os.path.isdir(DOWNLOAD_CACHE):
+        os.makedirs(DOWNLOAD_CACHE)
+
+    temp_path = os.path.join(DOWNLOAD_CACHE, "%s.%d.%d.part" % (key, os.getpid(), threading.get_ident()))
+    hasher = hashlib.sha256()
     try:
-        run_command([filename], True)
-        return True
+        response = urlopen(url, timeout=NETWORK_TIMEOUT)
+        with open(temp_path, "wb") as f:
+            for chunk in iter(lambda: response.read(1 << 16), b""):
+                hasher.update(chunk)
+                f.write(chunk)
+
+        digest = hasher.hexdigest()
+        if sha256 is not None and digest != sha256:
+            raise ValueError("Checksum mismatch for %s: expected %s, got %s" % (url, sha256, digest))
+
+        path = os.path.join(DOWNLOAD_CACHE, digest)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    _update_json(index_path, key, digest)
+    return path
+
+
+def hash_tree(paths, ignore=HASH_IGNORE):
+    # SHA-256 over the relative path and content of every file under paths
+    hasher = hashlib.sha256()
+    for root_path in paths:
+        if os.path.isfile(root_path):
+            files = [root_path]
+        else:
+            files = []
+            for directory, subdirectories, filenames in os.walk(root_path):
+                subdirectories[:] = sorted(d for d in subdirectories if not _ignored(d, ignore))
+                files.extend(os.path.join(directory, f) for f in sorted(filenames) if not _ignored(f, ignore))
+        for path in files:
+            hasher.update(os.path.relpath(path, BASE_DIR).encode("utf-8") + b"\0")
+            hasher.update(file_sha256(path).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def _ignored(name, ignore):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in ignore)
+
+
+def is_fresh(name, fingerprint):
+    return _read_json(BUILD_STATE).get(name) == fingerprint
+
+
+def mark_fresh(name, fingerprint):
+    _update_json(BUILD_STATE, name, fingerprint)
+
+
+def watch_changes(paths, ignore=HASH_IGNORE, debounce=WATCH_DEBOUNCE):
+    """
+    Yield the set of files that changed under paths, each time changes stop
+    for debounce seconds, so a burst of saves is reported once. Uses inotify
+    on Linux and polls modification times elsewhere.
+    """
+    try:
+        watcher = _InotifyWatcher(paths, ignore)
     except OSError:
-        return False
+        watcher = _PollingWatcher(paths, ignore)
+    try:
+        while True:
+            changed = set(watcher.read(None))
+            while True:
+                more = watcher.read(debounce)
+                if not more:
+                    break
+                changed.update(more)
+            if changed:
+                yield changed
+    finally:
+        watcher.close()
+
+
+def _watched(path, roots, ignore):
+    # Under one of the roots, and no part of it below the root is ignored
+    for root in roots:
+        if path == root or path.startswith(root + os.sep):
+            return not any(_ignored(part, ignore) for part in os.path.relpath(path, root).split(os.sep))
+    return False
+
+
+class _InotifyWatcher(object):
+    _MASK = 0x2 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200  # MODIFY, CLOSE_WRITE, MOVED_FROM/TO, CREATE, DELETE
+    _IN_ISDIR = 0x40000000
+    _IN_Q_OVERFLOW = 0x4000
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, paths, ignore):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify needs Linux")
+        import ctypes
+        import ctypes.util
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.roots = [os.path.abspath(path) for path in paths]
+        self.ignore = ignore
+        self._directories = {}
+        for root in self.roots:
+            if os.path.isdir(root):
+                self._add_tree(root)
+            else:
+                # Files are watched through their directory, which also sees editors replacing them
+                self._add_watch(os.path.dirname(root))
+
+    def _add_watch(self, directory):
+        wd = self._libc.inotify_add_watch(self.fd, directory.encode(sys.getfilesystemencoding()), self._MASK)
+        if wd >= 0:
+            self._directories[wd] = directory
+
+    def _add_tree(self, top):
+        added = []
+        for directory, subdirectories, filenames in os.walk(top):
+            subdirectories[:] = [d for d in subdirectories if not _ignored(d, self.ignore)]
+            self._add_watch(directory)
+            added.extend(os.path.join(directory, name) for name in filenames)
+        return added
+
+    def read(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0").decode(sys.getfilesystemencoding())
+            offset += length
+            if mask & self._IN_Q_OVERFLOW:
+                changed.extend(self.roots)
+                continue
+            if wd not in self._directories:
+                continue
+            path = os.path.join(self._directories[wd], name)
+            if mask & self._IN_ISDIR:
+                # A new directory's files may be written before its watch exists
+                if mask & 0x180 and _watched(path, self.roots, self.ignore):
+                    changed.extend(self._add_tree(path))
+                continue
+            changed.append(path)
+        return [path for path in changed if _watched(path, self.roots, self.ignore)]
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _PollingWatcher(object):
+    def __init__(self, paths, ignore):
+        self.roots = [os.path.abspath(path) for path in paths]
+        self.ignore = ignore
+        self._state = self._scan()
+
+    def _scan(self):
+        state = {}
+        for root in self.roots:
+            if os.path.isfile(root):
+                files = [root]
+            else:
+                files = []
+                for directory, subdirectories, filenames in os.walk(root):
+                    subdirectories[:] = [d for d in subdirectories if not _ignored(d, self.ignore)]
+                    files.extend(os.path.join(directory, f) for f in filenames if not _ignored(f, self.ignore))
+            for path in files:
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                state[path] = (info.st_mtime_ns, info.st_size)
+        return state
+
+    def read(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            time.sleep(WATCH_POLL_INTERVAL if deadline is None else max(0, min(WATCH_POLL_INTERVAL, deadline - time.time())))
+            state = self._scan()
+            changed = [path for path in set(state) | set(self._state) if state.get(path) != self._state.get(path)]
+            self._state = state
+            if changed or (deadline is not None and time.time() >= deadline):
+                return changed
+
+    def close(self):
+        pass
 
 
-def download_exec(url, dest):
-    dest = urlretrieve(url, dest)[0]
-    make_exec(dest)
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
 
 
 def make_exec(file):
@@ -914,9 +3402,141 @@ def make_exec(file):
     os.chmod(file, current_stat.st_mode | stat.S_IEXEC)
 
 
+def run_graph(graph, run, max_workers):
+    """
+    Call run(node) for every node of a dependency graph, mapping each node to
+    the nodes it depends on. Each node starts as soon as its dependencies have
+    finished, with at most max_workers running at once. Once one fails no new
+    nodes are started, the running ones finish and the first error is re-raised.
+    """
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    check_graph(graph)
+
+    pending = dict((node, set(dependencies)) for node, dependencies in graph.items())
+    running = {}
+    error = None
+    max_workers = max(1, max_workers)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if error is None:
+                # Only submit what can run straight away, so nothing queued starts after a failure
+                ready = [node for node, dependencies in pending.items() if not dependencies]
+                for node in ready[: max_workers - len(running)]:
+                    del pending[node]
+                    running[executor.submit(run, node)] = node
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                if future.exception() is not None:
+                    error = error or future.exception()
+                    continue
+                for dependencies in pending.values():
+                    dependencies.discard(node)
+
+    if error is not None:
+        raise error
+
+
+def check_graph(graph):
+    # Make sure every dependency is a node in the graph and that there are no cycles
+    for node, dependencies in graph.items():
+        for dependency in dependencies:
+            if dependency not in graph:
+                raise RuntimeError("'%s' depends on unknown '%s'" % (_node_name(node), _node_name(dependency)))
+
+    pending = dict((node, set(dependencies)) for node, dependencies in graph.items())
+    while pending:
+        ready = [node for node, dependencies in pending.items() if not dependencies]
+        if not ready:
+            raise RuntimeError("circular dependencies between %s" % ", ".join(sorted(map(_node_name, pending))))
+        for node in ready:
+            del pending[node]
+        for dependencies in pending.values():
+            dependencies.difference_update(ready)
+
+
+def _node_name(node):
+    return getattr(node, "__name__", str(node))
+
+
 def get_latest_github_version(repo):
-    result = urlopen("https://github.com/%s/releases/latest" % repo)
+    return resolve_version("github:%s" % repo, lambda: _fetch_latest_github_version(repo))
+
+
+def get_latest_kubectl_version():
+    return resolve_version("kubectl", _fetch_latest_kubectl_version)
+
+
+def _fetch_latest_github_version(repo):
+    result = urlopen("https://github.com/%s/releases/latest" % repo, timeout=NETWORK_TIMEOUT)
     return result.geturl().split("/")[-1]
+
+
+def _fetch_latest_kubectl_version():
+    result = urlopen("https://dl.k8s.io/release/stable.txt", timeout=NETWORK_TIMEOUT)
+    return result.read().decode("utf-8").strip()
+
+
+def resolve_version(name, lookup, ttl=None, lockfile=None):
+    """
+    Resolve the latest version of a tool, in order of preference from:
+    the lockfile pin, a cache entry younger than ttl, lookup(), and finally the
+    last version lookup() returned if the network is unavailable.
+    """
+    ttl = VERSION_CACHE_TTL if ttl is None else ttl
+    lockfile = lockfile or VERSION_LOCKFILE
+
+    if lockfile:
+        pinned = _read_json(lockfile).get(name)
+        if pinned:
+            return pinned
+
+    cached = _read_json(VERSION_CACHE).get(name)
+    if cached and time.time() - cached["resolved"] < ttl:
+        version = cached["version"]
+    else:
+        try:
+            version = lookup()
+        except (IOError, OSError, ValueError) as e:
+            if not cached:
+                raise
+            log("Could not look up the latest %s version (%s), using %s" % (name, e, cached["version"]))
+            version = cached["version"]
+        else:
+            _update_json(VERSION_CACHE, name, {"version": version, "resolved": time.time()})
+
+    if lockfile:
+        _update_json(lockfile, name, version)
+
+    return version
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _update_json(path, key, value):
+    # Re-read under the lock so concurrent resolutions don't drop each other's entries
+    with _VERSION_LOCK:
+        data = _read_json(path)
+        data[key] = value
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(temp_path, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(temp_path, path)
 [7:09 PM, 5/19/2024] Aaron Joel Cse Rec: from _future_ import absolute_import
 
 from django.contrib import admin